@@ -1,11 +1,16 @@
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
 import datetime
-from config import BOT_TOKEN, ADMIN_IDS
-from database import Database
-from qr_manager import generate_qr_code, parse_qr_data, read_qr_from_image
+from config import BOT_TOKEN, ADMIN_IDS, DB_WAL, DB_READERS, DB_GROUP_COMMIT_MS, DB_GROUP_COMMIT_MAX
+from config import QR_DECODE_WORKERS, QR_DECODE_QUEUE, QR_DECODE_TIMEOUT, QR_SCAN_CACHE_SIZE, QR_SCAN_CACHE_TTL
+from config import BROADCAST_RATE, BROADCAST_CONCURRENCY
+from database import Database, AsyncDatabase
+from broadcast import Broadcaster, classify_delivery_error, outcome_unknown, PERMANENT_FAILURES
+from qr_manager import parse_qr_data, parse_start_payload, set_bot_username, QRCardCache, card_cache_key, QRDecodePool, QRDecodeBusy, QRScanCache, get_decode_stats, get_card_template
+from telegram.error import BadRequest
 from keyboards import *
 import asyncio
+import time
 
 
 
@@ -96,11 +101,21 @@ def get_coffee_progress(current, total, style=None):  # ← ДОБАВЬ style=N
         return progress
 
 
+async def record_delivery_failure(customer_id, error):
+    """Классифицирует ошибку отправки; постоянно недоступных исключаем из рассылок и уведомлений"""
+    kind = classify_delivery_error(error)
+    if kind in PERMANENT_FAILURES:
+        await adb.set_user_unreachable(customer_id, kind)
+        print(f"🚫 Пользователь {customer_id} недоступен: {kind}")
+    return kind
+
 async def notify_customer(bot, customer_id, new_count, required):
+    # Заблокировавшим бота и удалённым аккаунтам не пишем
+    if await adb.is_user_unreachable(customer_id):
+        return
+
     # Получаем данные клиента для имени
-    cursor = db.conn.cursor()
-    cursor.execute('SELECT username, first_name, last_name FROM users WHERE user_id = ?', (customer_id,))
-    user_info = cursor.fetchone()
+    user_info = await adb.get_user_info(customer_id)
     
     username = user_info[0] if user_info and user_info[0] else "Не указан"
     first_name = user_info[1] if user_info and user_info[1] else ""
@@ -152,13 +167,19 @@ async def notify_customer(bot, customer_id, new_count, required):
     
     except Exception as e:
         print(f"❌ Не удалось отправить стикер клиенту {customer_id}: {e}")
+        if await record_delivery_failure(customer_id, e) in PERMANENT_FAILURES:
+            return  # заблокировал бота или удалил аккаунт — текст тоже не дойдёт
         if was_seventh_purchase:
             message = f"{user_display_name}\n\n{progress_bar}            ☑ new    \n\nНапиток в подарок 🎁"
         elif was_sixth_purchase:
             message = f"{user_display_name}\n\n{progress_bar}            ☑ new    \n\nСледующий напиток в подарок"
         else:
             message = f"{user_display_name}\n\n{progress_bar}            ☑ new    "
-        await bot.send_message(customer_id, message)
+        try:
+            await bot.send_message(customer_id, message)
+        except Exception as e:
+            kind = await record_delivery_failure(customer_id, e)
+            print(f"❌ Не удалось уведомить клиента {customer_id} ({kind}): {e}")
         
 async def get_sticker_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда для получения ID любого стикера"""
@@ -176,7 +197,19 @@ async def handle_sticker(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"📏 Набор: {sticker.set_name or 'нет'}",
         parse_mode='Markdown'
     )
-db = Database()
+# БД открывается в init_database() при запуске, а не при импорте: процессы
+# распознавания QR (spawn) заново импортируют этот модуль и не должны трогать БД
+db = None
+adb = None
+
+def init_database():
+    global db, adb
+    db = Database(wal=DB_WAL, readers=DB_READERS,
+                  group_commit_ms=DB_GROUP_COMMIT_MS, group_commit_max=DB_GROUP_COMMIT_MAX,
+                  admin_ids=ADMIN_IDS)
+    # все обращения к БД из обработчиков идут через потоки БД;
+    # в режиме WAL по потоку на каждое соединение-читатель
+    adb = AsyncDatabase(db, workers=max(1, DB_READERS) if DB_WAL else 1)
 
 # ================== СИСТЕМА СОСТОЯНИЙ ==================
 def set_user_state(context, state):
@@ -186,26 +219,30 @@ def get_user_state(context):
     return context.user_data.get('state', 'main')
 
 def is_admin(user_id):
-    return user_id in ADMIN_IDS     # ← список из config.py
+    return db.is_admin(user_id)     # ← ADMIN_IDS из config.py + таблица admins
 
 def get_user_role(user_id, username):
-    """Определяет роль пользователя"""
-    if is_admin(user_id):
-        return 'admin'
-    elif username and db.is_user_barista(username):
-        return 'barista'
-    else:
-        return 'client'
+    """Определяет роль пользователя (индекс ролей в памяти, без SQL)"""
+    return db.get_user_role(user_id, username)
 
 # ================== ОСНОВНЫЕ КОМАНДЫ ==================
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     user_id = user.id
 
-    db.get_or_create_user(user_id, user.username, user.first_name, user.last_name)
+    await adb.get_or_create_user(user_id, user.username, user.first_name, user.last_name)
     set_user_state(context, 'main')
     
     role = get_user_role(user_id, user.username)
+
+    # Бариста навёл камеру на карточку: t.me/<бот>?start=cr_<id> → сразу карточка клиента
+    customer_id = parse_start_payload(context.args[0]) if context.args else None
+    if customer_id and role in ('barista', 'admin'):
+        if role == 'admin':
+            set_user_state(context, 'barista_mode')
+        print(f"🔗 Скан по ссылке: бариста {user_id} → клиент {customer_id}")
+        await process_customer_scan(update, context, customer_id)
+        return
     
     if role == 'admin':
         await show_admin_main(update)
@@ -214,7 +251,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await show_client_main(update, context)  # ← ДОБАВЬТЕ context здесь
     print(f"🔍 user_id={user_id}, username=@{user.username}")
-    print(f"📨 роль={get_user_role(user_id, user.username)}")
+    print(f"📨 роль={role}")
 # ================== РЕЖИМ КЛИЕНТА ==================
 async def show_client_main(update: Update, context: ContextTypes.DEFAULT_TYPE = None):
     user = update.effective_user
@@ -277,6 +314,45 @@ async def show_barista_main(update: Update):
             await update.callback_query.edit_message_text(text, reply_markup=get_barista_keyboard())
 
 
+qr_decoder = None  # пул процессов распознавания, создаётся в on_startup
+# file_unique_id фото → найденные клиенты, чтобы повторное/пересланное фото не распознавать заново
+qr_scan_cache = QRScanCache(max_items=QR_SCAN_CACHE_SIZE, ttl=QR_SCAN_CACHE_TTL)
+
+# Минимальная сторона первой скачиваемой версии фото: карточка QR обычно
+# читается уже с ~800px, оригинал качаем только если не получилось
+PHOTO_MIN_SIDE = 640
+
+async def download_photo(photo):
+    photo_file = await photo.get_file()
+    return await photo_file.download_as_bytearray()
+
+async def download_and_decode_photo(photo_sizes):
+    """
+    Прогрессивное распознавание: начинаем с самой маленькой версии фото
+    не меньше PHOTO_MIN_SIDE и переходим к следующей по размеру, только
+    если QR не нашёлся; распознавание останавливается на первом успешном этапе.
+    Возвращает список текстов QR (пустой, если ничего нет).
+    Если на фото оказалось несколько карточек, оригинал проходит все этапы:
+    быстрый проход мог найти не все карточки группового заказа.
+    """
+    sizes = sorted(photo_sizes, key=lambda p: p.width * p.height)
+    candidates = [p for p in sizes if max(p.width, p.height) >= PHOTO_MIN_SIDE] or sizes[-1:]
+
+    for photo in candidates:
+        photo_bytes = await download_photo(photo)
+        qr_texts = await qr_decoder.decode(photo_bytes, multi=True)
+        print(f"🔍 Фото {photo.width}x{photo.height}: {'QR найдено: ' + str(len(qr_texts)) if qr_texts else 'QR не найден'}")
+        if len(qr_texts) > 1:
+            original = sizes[-1]
+            if original is not photo:
+                photo_bytes = await download_photo(original)
+            full = await qr_decoder.decode(photo_bytes, multi=True, exhaustive=True)
+            print(f"🔍 Групповое фото {original.width}x{original.height}: QR найдено: {len(full)}")
+            return list(dict.fromkeys(qr_texts + full))
+        if qr_texts:
+            return qr_texts
+    return []
+
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка фотографии с QR-кодом"""
     user_id = update.effective_user.id
@@ -292,30 +368,48 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         processing_msg = await update.message.reply_text("🔍 Обрабатываю QR-код...")
         
-        # Сначала получаем фото
-        photo = update.message.photo[-1]
-        photo_file = await photo.get_file()
-        photo_bytes = await photo_file.download_as_bytearray()
-        
-        qr_data = read_qr_from_image(bytes(photo_bytes))
-        if not qr_data:
-            await processing_msg.edit_text("❌ Не удалось распознать QR-код")
-            return
-        
-        customer_id = parse_qr_data(qr_data)
-        if not customer_id:
-            await processing_msg.edit_text("❌ Неверный формат QR-кода")
-            return
+        # Это фото уже распознавали (повторная отправка или пересылка)
+        file_unique_id = update.message.photo[-1].file_unique_id
+        customer_ids = qr_scan_cache.get(file_unique_id)
+        if customer_ids is None:
+            # Качаем фото по возрастанию размера и распознаём в пуле процессов;
+            # несколько карточек на фото — полный проход по оригиналу
+            try:
+                qr_texts = await download_and_decode_photo(update.message.photo)
+            except QRDecodeBusy:
+                await processing_msg.edit_text("⏳ Сканер занят, отправьте фото ещё раз через пару секунд")
+                return
+            except asyncio.TimeoutError:
+                await processing_msg.edit_text("❌ Не удалось распознать QR-код: слишком долго, попробуйте переснять")
+                return
+            if not qr_texts:
+                await processing_msg.edit_text("❌ Не удалось распознать QR-код")
+                return
+            
+            # На одном фото может быть несколько карточек (групповой заказ)
+            customer_ids = list(dict.fromkeys(cid for cid in map(parse_qr_data, qr_texts) if cid))
+            if not customer_ids:
+                await processing_msg.edit_text("❌ Неверный формат QR-кода")
+                return
+            qr_scan_cache.put(file_unique_id, customer_ids)
+        else:
+            print(f"🔍 Фото {file_unique_id}: клиенты из кеша {customer_ids}")
         
         # ТЕПЕРЬ УДАЛЯЕМ ФОТО И СООБЩЕНИЕ ОБ ОБРАБОТКЕ
         await update.message.delete()  # удаляем фото QR-кода
         await processing_msg.delete()  # удаляем сообщение "Обрабатываю..."
         
+        if len(customer_ids) > 1:
+            await update.message.reply_text(f"✅ Найдено клиентов по QR-кодам: {len(customer_ids)}")
+            await asyncio.sleep(0.5)
+            await process_group_scan(update, context, customer_ids)
+            return
+
         # ✅ ДОБАВЛЯЕМ УВЕДОМЛЕНИЕ О НАЙДЕННОМ КЛИЕНТЕ
         await update.message.reply_text("✅ Найден клиент по QR-коду")
         await asyncio.sleep(0.5)
         
-        await process_customer_scan(update, context, customer_id)
+        await process_customer_scan(update, context, customer_ids[0])
 
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка обработки: {str(e)}")
@@ -351,14 +445,12 @@ async def process_customer_scan(update: Update, context: ContextTypes.DEFAULT_TY
     user_emoji = context.user_data['customer_emoji']
     
     # Получаем данные клиента
-    purchases = db.get_user_stats(customer_id)
+    purchases = await adb.get_user_stats(customer_id)
     if purchases is None:
-        await update.message.reply_text("❌ Клиент не найден в базе данных.")
+        await update.effective_message.reply_text("❌ Клиент не найден в базе данных.")
         return
     
-    cursor = db.conn.cursor()
-    cursor.execute('SELECT username, first_name, last_name, phone FROM users WHERE user_id = ?', (customer_id,))
-    user_info = cursor.fetchone()
+    user_info = await adb.get_user_info(customer_id)
     
     username = user_info[0] if user_info and user_info[0] else "Не указан"
     first_name = user_info[1] if user_info and user_info[1] else ""
@@ -398,6 +490,7 @@ async def process_customer_scan(update: Update, context: ContextTypes.DEFAULT_TY
     
     # Сохраняем ID клиента для возможного повторного начисления через ✔ Начислить
     context.user_data['current_customer'] = customer_id
+    context.user_data.pop('current_customers', None)
     
     # ✅ АВТОМАТИЧЕСКИ ОБНОВЛЯЕМ КЛАВИАТУРУ
     keyboard = [
@@ -412,8 +505,109 @@ async def process_customer_scan(update: Update, context: ContextTypes.DEFAULT_TY
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     
     # Отправляем сообщение с информацией о клиенте и ОБНОВЛЕННОЙ клавиатурой
-    await update.message.reply_text(text, reply_markup=reply_markup)    
+    await update.effective_message.reply_text(text, reply_markup=reply_markup)    
     # Бариста теперь может нажать ✔ Начислить для начисления покупки
+
+def format_customer_name(username, first_name, last_name):
+    """Имя Фамилия > @username > Гость"""
+    clean_last_name = last_name if last_name and last_name != "None" else ""
+    name = f"{first_name or ''} {clean_last_name}".strip()
+    if not name:
+        name = f"@{username}" if username else "Гость"
+    return name
+
+async def process_group_scan(update: Update, context: ContextTypes.DEFAULT_TYPE, customer_ids):
+    """Общая карточка для нескольких клиентов с одного фото"""
+    role = get_user_role(update.effective_user.id, update.effective_user.username)
+    promotion = db.get_promotion()
+    required = promotion.required_purchases if promotion else 7
+
+    stats = await asyncio.gather(*(adb.get_user_stats(cid) for cid in customer_ids))
+    infos = await asyncio.gather(*(adb.get_user_info(cid) for cid in customer_ids))
+
+    found = []
+    lines = []
+    for cid, purchases, info in zip(customer_ids, stats, infos):
+        if purchases is None or not info:
+            lines.append(f"❔ {cid} — не найден в базе данных")
+            continue
+        found.append(cid)
+        name = format_customer_name(info[0], info[1], info[2])
+        if purchases >= required:
+            status_text = "🎉 Бесплатный напиток!"
+        elif required - purchases - 1 == 0:
+            status_text = "Следующий 🎁"
+        else:
+            status_text = f"Ещё {required - purchases - 1}"
+        lines.append(f"{get_random_user_emoji()} {name}\n{get_coffee_progress(purchases, required)}\n{status_text}")
+
+    if not found:
+        await update.effective_message.reply_text("❌ Клиенты не найдены в базе данных.")
+        return
+
+    # ✔ Начислить начислит всем найденным клиентам сразу
+    context.user_data['current_customers'] = found
+    context.user_data['current_customer'] = None
+
+    keyboard = [
+        [KeyboardButton("✔ Начислить")],
+        [KeyboardButton("🧾 Инфо")]
+    ]
+    if role == 'admin':
+        keyboard.append([KeyboardButton("🔙 Назад")])
+
+    text = f"👥 Групповой заказ: {len(found)}\n\n" + "\n\n".join(lines)
+    await update.effective_message.reply_text(text, reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+
+async def process_group_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE, customer_ids):
+    """Начисление всем клиентам группового заказа одной транзакцией"""
+    results = await adb.credit_purchases(customer_ids, 1)
+    if not results:
+        await update.message.reply_text("❌ Клиенты не найдены в базе данных.")
+        return
+
+    lines = []
+    for cid, (new_count, required, username, first_name, last_name) in results.items():
+        name = format_customer_name(username, first_name, last_name)
+        if new_count == 0:
+            # счётчик сброшен — это была подарочная покупка
+            lines.append(f"🎁 {name}\n{get_coffee_progress(required, required)}  напиток в подарок")
+        else:
+            lines.append(f"☑ {name}\n{get_coffee_progress(new_count, required)}")
+
+    sticker_msg = await update.message.reply_sticker("CAACAgIAAxkBAAIXcmkJz75zJHyaWzadj8tpXsWv8PTsAAKgkwACe69JSNZ_88TxnRpuNgQ")
+    await update.message.reply_text(f"👥 Начислено: {len(results)}\n\n" + "\n\n".join(lines))
+
+    async def delete_sticker_later():
+        await asyncio.sleep(3)
+        try:
+            await sticker_msg.delete()
+        except Exception:
+            pass
+
+    asyncio.create_task(delete_sticker_later())
+
+    # Уведомления клиентам отправляем параллельно, ошибка одного не мешает остальным
+    notifications = await asyncio.gather(
+        *(notify_customer(context.bot, cid, r[0], r[1]) for cid, r in results.items()),
+        return_exceptions=True,
+    )
+    for cid, outcome in zip(results, notifications):
+        if isinstance(outcome, Exception):
+            print(f"❌ Не удалось уведомить клиента {cid}: {outcome}")
+
+async def credit_current_customer(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """✔ Начислить: текущему клиенту или всем клиентам группового заказа"""
+    customer_ids = context.user_data.get('current_customers')
+    if customer_ids:
+        await process_group_purchase(update, context, customer_ids)
+        return
+    customer_id = context.user_data.get('current_customer')
+    if customer_id:
+        await process_coffee_purchase(update, context, customer_id)
+    else:
+        await update.message.reply_text("❌ Сначала найдите клиента по QR или номеру")
+
 async def process_coffee_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE, customer_id: int):
     """Обработка начисления покупки по кнопке ✔ Начислить"""
     print(f"🔴 DEBUG process_coffee_purchase: начали, customer_id={customer_id}")
@@ -433,22 +627,16 @@ async def process_coffee_purchase(update: Update, context: ContextTypes.DEFAULT_
     user_emoji = context.user_data.get('customer_emoji', get_random_user_emoji())
     user_id = update.effective_user.id
     
-    # Получаем текущее количество покупок ДО начисления
-    current_purchases = db.get_user_stats(customer_id)
-    promotion = db.get_promotion()
-    required = promotion[2] if promotion else 7
-
-    print(f"🟡 DEBUG: ДО начисления - current_purchases={current_purchases}, required={required}")
-
-    # Начисляем покупку
-    new_count = db.update_user_purchases(customer_id, 1)
+    # Начисляем покупку одним запросом: новый счётчик, условие акции и имя клиента
+    result = await adb.credit_purchase(customer_id, 1)
+    if result is None:
+        await update.message.reply_text("❌ Клиент не найден в базе данных.")
+        return
+    new_count, required = result[0], result[1]
 
-    print(f"🟡 DEBUG: ПОСЛЕ начисления - new_count={new_count}")
+    print(f"🟡 DEBUG: ПОСЛЕ начисления - new_count={new_count}, required={required}")
 
-    # Получаем данные клиента
-    cursor = db.conn.cursor()
-    cursor.execute('SELECT username, first_name, last_name FROM users WHERE user_id = ?', (customer_id,))
-    user_info = cursor.fetchone()
+    user_info = result[2:]
 
     username = user_info[0] if user_info and user_info[0] else "Не указан"
     first_name = user_info[1] if user_info and user_info[1] else ""
@@ -461,13 +649,13 @@ async def process_coffee_purchase(update: Update, context: ContextTypes.DEFAULT_
         user_display_name = f"@{username}" if username and username != "Не указан" else "Гость"
 
     # Надпись показываем когда было 5 покупок (стало 6)
-    show_gift_message = (current_purchases == required - 2)  # 5 покупок при required=7
+    show_gift_message = (required >= 2 and new_count == required - 1)  # стало 6 при required=7
     
     # Анимация подарка когда было 6 покупок (стало 0) - 7-я покупка
-    show_gift_animation = (current_purchases == required - 1)  # 6 покупок при required=7
+    show_gift_animation = (new_count == 0)  # счётчик сброшен при начислении
     
-    print(f"🟡 DEBUG: show_gift_message={show_gift_message} (current_purchases={current_purchases} == required-2={required-2})")
-    print(f"🟡 DEBUG: show_gift_animation={show_gift_animation} (current_purchases={current_purchases} == required-1={required-1})")
+    print(f"🟡 DEBUG: show_gift_message={show_gift_message} (new_count={new_count} == required-1={required-1})")
+    print(f"🟡 DEBUG: show_gift_animation={show_gift_animation} (new_count={new_count})")
 
     # Прогресс-бар
     progress_bar = get_coffee_progress(new_count, required, style)
@@ -522,7 +710,9 @@ async def show_admin_main(update: Update):
     if update.message:
         await update.message.reply_text(text, reply_markup=get_admin_main_keyboard())
     else:
-        await update.callback_query.edit_message_text(text, reply_markup=get_admin_main_keyboard())
+        # обычную клавиатуру нельзя прикрепить при редактировании, поэтому
+        # новым сообщением; сообщение с кнопками (статус рассылки) остаётся как есть
+        await update.callback_query.message.reply_text(text, reply_markup=get_admin_main_keyboard())
 
 async def handle_admin_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
@@ -540,6 +730,7 @@ async def handle_admin_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "✍ Введите текст для рассылки:\n\n"
             "!c - только клиентам\n"
             "!b - только баристам\n"
+            "!a - покупавшим за последние 30 дней\n"
             "без префикса - всем пользователям"
         )
     elif text == "⚙️ Опции":
@@ -581,13 +772,7 @@ async def handle_broadcast_message(update: Update, context: ContextTypes.DEFAULT
     
     # ПРЕДПРОСМОТР с инлайн кнопками
 # ПРЕДПРОСМОТР с инлайн кнопками
-    target_info = ""
-    if broadcast_text.startswith('!c '):
-        target_info = " (только клиентам)"
-    elif broadcast_text.startswith('!b '):
-        target_info = " (только баристам)"
-    else:
-        target_info = " (всем пользователям)"
+    target_info = f" ({BROADCAST_AUDIENCE_TEXT[split_broadcast_target(broadcast_text)[0]]})"
 
     preview_text = f"📣 Предпросмотр рассылки{target_info}:\n\n{broadcast_text}"
 
@@ -633,11 +818,52 @@ async def handle_broadcast_buttons(update: Update, context: ContextTypes.DEFAULT
         await query.edit_message_text("❌ Рассылка отменена")
         set_user_state(context, 'main')
         await show_admin_main(update)
-    elif data == "broadcast_delete":
-        await delete_broadcast_from_users(update, context)
+    elif data.startswith("broadcast_delete_"):
+        await delete_broadcast_from_users(update, context, int(data.replace("broadcast_delete_", "")))
+
+broadcast_task = None  # фоновый обработчик заданий рассылки: задания идут по очереди
+broadcast_wakeup = asyncio.Event()  # есть новое задание — будим обработчик
+_broadcaster = None
+
+def get_broadcaster(bot):
+    """Один Broadcaster на бота: общий лимит скорости для всех рассылок"""
+    global _broadcaster
+    if _broadcaster is None:
+        _broadcaster = Broadcaster(bot, rate=BROADCAST_RATE, concurrency=BROADCAST_CONCURRENCY)
+    return _broadcaster
+
+BROADCAST_CHUNK = 500
+BROADCAST_RESULTS_BATCH = 100  # итоги отправок пишутся в БД пачками, а не по одному
+
+# Префикс текста рассылки → сегмент аудитории (AUDIENCE_SEGMENTS в database.py)
+BROADCAST_TARGETS = {'!b ': 'baristas', '!c ': 'clients', '!a ': 'active30'}
+BROADCAST_AUDIENCE_TEXT = {
+    "all": "всем пользователям",
+    "baristas": "только баристам",
+    "clients": "только клиентам",
+    "active30": "покупавшим за 30 дней",
+}
+
+def split_broadcast_target(broadcast_text):
+    """'!c Текст' → ('clients', 'Текст'); без префикса — всем"""
+    for prefix, target in BROADCAST_TARGETS.items():
+        if broadcast_text.startswith(prefix):
+            return target, broadcast_text[len(prefix):].strip()
+    return "all", broadcast_text
+
+async def iter_pending_deliveries(broadcast_id):
+    """Ещё не отправленные получатели задания, кусками из БД"""
+    after_id = 0
+    while True:
+        chunk = await adb.get_pending_deliveries(broadcast_id, after_id, BROADCAST_CHUNK)
+        for customer_id in chunk:
+            yield customer_id
+        if len(chunk) < BROADCAST_CHUNK:
+            return
+        after_id = chunk[-1]
 
 async def send_broadcast_to_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Отправляет рассылку пользователям с фильтрацией"""
+    """Сохраняет рассылку как задание в БД и запускает её в фоне"""
     query = update.callback_query
     broadcast_text = context.user_data.get('broadcast_text')
     
@@ -646,127 +872,272 @@ async def send_broadcast_to_users(update: Update, context: ContextTypes.DEFAULT_
         return
     
     # Определяем фильтр получателей
-    target_audience = "all"  # по умолчанию всем
-    
-    if broadcast_text.startswith('!b '):
-        target_audience = "baristas"
-        broadcast_text = broadcast_text[3:].strip()  # Убираем /b
-    elif broadcast_text.startswith('!c '):
-        target_audience = "clients" 
-        broadcast_text = broadcast_text[3:].strip()  # Убираем /c
+    target_audience, broadcast_text = split_broadcast_target(broadcast_text)
     
     # Обновляем существующее сообщение
     await query.edit_message_text(
         f"🔄 Отправка рассылки...\n\nЦелевая аудитория: {target_audience}\n\n{broadcast_text}"
     )
-    
-    # Получаем всех пользователей
-    all_user_ids = db.get_all_user_ids()
-    sent_count = 0
-    failed_count = 0
-    sent_messages = []
-    
-    admin_id = context.user_data.get('admin_chat_id')
-    
-    for customer_id in all_user_ids:
-        if customer_id == admin_id:
+
+    # Получатели фиксируются сразу: после перезапуска задание продолжится с того же места
+    broadcast_id, total = await adb.create_broadcast(
+        broadcast_text, target_audience, context.user_data.get('admin_chat_id'),
+        query.message.chat_id, query.message.message_id,
+    )
+    context.user_data.pop('broadcast_text', None)
+    print(f"📣 Рассылка #{broadcast_id}: {total} получателей")
+
+    # Сама отправка идёт в фоне, обработчик админа не ждёт её окончания
+    ensure_broadcast_runner(context.bot)
+    set_user_state(context, 'main')
+    await show_admin_main(update)
+
+def ensure_broadcast_runner(bot):
+    """Будит фоновый обработчик заданий рассылки или запускает его, если он не работает"""
+    global broadcast_task
+    broadcast_wakeup.set()
+    if broadcast_task is None or broadcast_task.done():
+        # Обычная задача asyncio, а не application.create_task: при остановке бота
+        # её отменяют, а не ждут окончания рассылки
+        broadcast_task = asyncio.create_task(run_broadcast_jobs(bot))
+
+async def run_broadcast_jobs(bot):
+    """
+    Выполняет незавершённые задания рассылки и отзыва по очереди, а когда их нет —
+    ждёт broadcast_wakeup. Обработчик не завершается сам: иначе задание, созданное
+    между пустой проверкой и выходом, осталось бы без обработчика до перезапуска.
+    """
+    while True:
+        # сбрасываем до проверки: задание, созданное после неё, снова поднимет флаг
+        broadcast_wakeup.clear()
+        active = await adb.get_active_broadcasts()
+        if not active:
+            await broadcast_wakeup.wait()
             continue
-        
-        # Определяем роль пользователя
-        cursor = db.conn.cursor()
-        cursor.execute('SELECT username FROM users WHERE user_id = ?', (customer_id,))
-        user_info = cursor.fetchone()
-        username = user_info[0] if user_info else None
-        user_role = get_user_role(customer_id, username)
-        
-        # Применяем фильтр
-        if target_audience == "baristas" and user_role != "barista":
-            continue  # Пропускаем не-барист
-        elif target_audience == "clients" and user_role != "client":
-            continue  # Пропускаем не-клиентов
-        # Если target_audience == "all" - отправляем всем
+        broadcast_id, status = active[0]
+        if status == 'recalling':
+            await run_recall(bot, broadcast_id)
+        else:
+            await run_broadcast(bot, broadcast_id)
+
+async def edit_broadcast_status(bot, chat_id, message_id, text, reply_markup=None):
+    """Прогресс задания в сообщении админа"""
+    if not chat_id or not message_id:
+        return
+    try:
+        await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, reply_markup=reply_markup)
+    except Exception as e:
+        print(f"⚠️ Не удалось обновить статус рассылки: {e}")
+
+async def run_broadcast(bot, broadcast_id):
+    """Фоновая рассылка задания: прогресс и итог пишутся в сообщение админа"""
+    _, broadcast_text, target_audience, _, chat_id, message_id, _, _, _ = await adb.get_broadcast(broadcast_id)
+
+    async def edit_status(text, reply_markup=None):
+        await edit_broadcast_status(bot, chat_id, message_id, text, reply_markup)
+
+    try:
+        # Отправки, прерванные перезапуском, могли дойти — не повторяем их
+        unknown = await adb.reset_inflight_deliveries(broadcast_id)
+        if unknown:
+            print(f"⚠️ Рассылка #{broadcast_id}: {unknown} отправок прервано перезапуском, пропускаем")
+        progress = await adb.get_broadcast_progress(broadcast_id)
+        total = sum(progress.values())
+        done_before = total - progress.get('pending', 0)
+        started = time.monotonic()
+
+        async def send(customer_id):
+            # Отметка до отправки: если бот упадёт посреди вызова, получатель станет unknown
+            await adb.mark_delivery_sending(broadcast_id, customer_id)
+            return await bot.send_message(chat_id=customer_id, text=broadcast_text)
+
+        # Итоги копятся и пишутся одной транзакцией на пачку или тик прогресса.
+        # Если бот упадёт до записи, эти получатели останутся sending → unknown
+        # и не получат сообщение повторно.
+        results = []
+
+        async def flush_results():
+            if results:
+                batch = results[:]
+                results.clear()
+                await adb.set_delivery_results(broadcast_id, batch)
+
+        async def on_result(customer_id, sent_msg, error):
+            if sent_msg:
+                results.append((customer_id, 'sent', sent_msg.message_id, None))
+            elif outcome_unknown(error):
+                # таймаут после отправки: сообщение могло дойти, повторять нельзя
+                results.append((customer_id, 'unknown', None, f"transient: {error}"))
+            else:
+                kind = await record_delivery_failure(customer_id, error)
+                results.append((customer_id, 'failed', None, f"{kind}: {error}"))
+            if len(results) >= BROADCAST_RESULTS_BATCH:
+                await flush_results()
+
+        async def on_progress(stats):
+            await flush_results()
+            done = done_before + stats['ok'] + stats['failed']
+            await edit_status(
+                f"🔄 Отправка рассылки: {done}/{total}\n"
+                f"📤 Отправлено: {stats['ok']}, ошибок: {stats['failed']}\n\n{broadcast_text}"
+            )
+
+        try:
+            stats = await get_broadcaster(bot).run(
+                iter_pending_deliveries(broadcast_id), send,
+                on_result=on_result, on_progress=on_progress,
+            )
+        finally:
+            await flush_results()
+        await adb.finish_broadcast(broadcast_id, 'done')
+        print(f"📣 Рассылка #{broadcast_id}: {stats['ok']}/{stats['total']} за {time.monotonic() - started:.1f} с")
+
+        progress = await adb.get_broadcast_progress(broadcast_id)
+        if progress.get('sent'):
+            result_text = (
+                f"✅ Рассылка отправлена!\n"
+                f"🎯 Аудитория: {BROADCAST_AUDIENCE_TEXT[target_audience]}\n"
+                f"📤 Отправлено: {progress.get('sent', 0)}\n"
+                f"❌ Ошибок: {progress.get('failed', 0)}\n"
+            )
+            if progress.get('unknown'):
+                result_text += f"❔ Неизвестно, дошло ли (таймаут или перезапуск): {progress['unknown']}\n"
+            failures = await adb.get_broadcast_failures(broadcast_id)
+            unreachable = sum(failures.get(kind, 0) for kind in PERMANENT_FAILURES)
+            if unreachable:
+                result_text += f"🚫 Недоступны (исключены из будущих рассылок): {unreachable}\n"
+            result_text += f"\nТекст: {broadcast_text}"
             
+            keyboard = [[
+                InlineKeyboardButton("🗑️ Удалить у всех", callback_data=f"broadcast_delete_{broadcast_id}")
+            ]]
+            
+            await edit_status(result_text, reply_markup=InlineKeyboardMarkup(keyboard))
+        else:
+            await edit_status("❌ Не удалось отправить ни одному пользователю")
+    except Exception as e:
+        print(f"❌ Ошибка рассылки #{broadcast_id}: {e}")
+        await adb.finish_broadcast(broadcast_id, 'failed')
+        await edit_status(f"❌ Рассылка прервана: {e}")
+
+
+async def iter_recall_batch(broadcast_id):
+    """Ещё не удалённые сообщения рассылки (chat_id, message_id), кусками из БД"""
+    after_id = 0
+    while True:
+        chunk = await adb.get_recall_batch(broadcast_id, after_id, BROADCAST_CHUNK)
+        for pair in chunk:
+            yield pair
+        if len(chunk) < BROADCAST_CHUNK:
+            return
+        after_id = chunk[-1][0]
+
+async def run_recall(bot, broadcast_id):
+    """Фоновое удаление рассылки у получателей по сохранённым message_id"""
+    _, broadcast_text, _, _, chat_id, message_id, _, _, _ = await adb.get_broadcast(broadcast_id)
+
+    try:
+        progress = await adb.get_broadcast_progress(broadcast_id)
+        total = progress.get('sent', 0) + progress.get('deleted', 0) + progress.get('delete_failed', 0)
+        done_before = total - progress.get('sent', 0)
+
+        # Итоги удаления пишутся пачками, как итоги отправки. Если бот упадёт
+        # до записи, эти сообщения останутся sent и после перезапуска удаление
+        # повторится (удаление идемпотентно, уже удалённые дадут ошибку)
+        results = []
+
+        async def flush_results():
+            if results:
+                batch = results[:]
+                results.clear()
+                await adb.set_recall_results(broadcast_id, batch)
+
+        async def on_result(pair, result, error):
+            results.append((pair[0], error is None, None if error is None else str(error)))
+            if len(results) >= BROADCAST_RESULTS_BATCH:
+                await flush_results()
+
+        async def on_progress(stats):
+            await flush_results()
+            await edit_broadcast_status(
+                bot, chat_id, message_id,
+                f"🔄 Удаление рассылки #{broadcast_id}: {done_before + stats['ok'] + stats['failed']}/{total}\n"
+                f"🗑️ Удалено: {stats['ok']}, ошибок: {stats['failed']}"
+            )
+
         try:
-            sent_msg = await context.bot.send_message(
-                chat_id=customer_id,
-                text=broadcast_text
+            stats = await get_broadcaster(bot).delete_messages(
+                iter_recall_batch(broadcast_id), on_result=on_result, on_progress=on_progress,
             )
-            sent_count += 1
-            sent_messages.append((customer_id, sent_msg.message_id))
-        except Exception as e:
-            print(f"❌ Не удалось отправить пользователю {customer_id}: {e}")
-            failed_count += 1
-        await asyncio.sleep(0.1)
-    
-    # Сохраняем информацию для удаления
-    if sent_messages:
-        context.user_data['last_broadcast'] = {
-            'messages': sent_messages,
-            'text': broadcast_text,
-            'target': target_audience
-        }
-        
-        # Показываем результат
-        audience_text = {
-            "all": "всем пользователям",
-            "baristas": "только баристам", 
-            "clients": "только клиентам"
-        }
-        
-        result_text = (
-            f"✅ Рассылка отправлена!\n"
-            f"🎯 Аудитория: {audience_text[target_audience]}\n"
-            f"📤 Отправлено: {sent_count}\n\n"
-            f"Текст: {broadcast_text}"
-        )
-        
-        keyboard = [[
-            InlineKeyboardButton("🗑️ Удалить у всех", callback_data="broadcast_delete")
-        ]]
-        
-        await query.edit_message_text(
-            result_text,
-            reply_markup=InlineKeyboardMarkup(keyboard)
+        finally:
+            await flush_results()
+        await adb.finish_broadcast(broadcast_id, 'recalled')
+        print(f"🗑️ Рассылка #{broadcast_id}: удалено {stats['ok']}/{stats['total']}")
+
+        progress = await adb.get_broadcast_progress(broadcast_id)
+        text = (
+            f"🗑️ Удалено {progress.get('deleted', 0)} сообщений рассылки #{broadcast_id}\n"
         )
-    else:
-        await query.edit_message_text("❌ Не удалось отправить ни одному пользователю")
-    
-    set_user_state(context, 'main')
-    await show_admin_main(update)
-
+        if progress.get('delete_failed'):
+            # Telegram даёт удалять сообщения бота только в течение 48 часов
+            text += f"❌ Не удалось удалить: {progress['delete_failed']}\n"
+        text += f"Текст: {broadcast_text}"
+        await edit_broadcast_status(bot, chat_id, message_id, text)
+    except Exception as e:
+        print(f"❌ Ошибка удаления рассылки #{broadcast_id}: {e}")
+        await adb.finish_broadcast(broadcast_id, 'recall_failed')
+        await edit_broadcast_status(bot, chat_id, message_id, f"❌ Удаление прервано: {e}")
 
-async def delete_broadcast_from_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Удаляет рассылку у всех пользователей"""
+async def delete_broadcast_from_users(update: Update, context: ContextTypes.DEFAULT_TYPE, broadcast_id):
+    """Ставит удаление рассылки у всех пользователей в фоновую очередь"""
     query = update.callback_query
-    await query.answer()
     
-    broadcast_data = context.user_data.get('last_broadcast')
-    if not broadcast_data:
-        await query.edit_message_text("❌ Нет данных о последней рассылке")
+    if not await adb.start_recall(broadcast_id, query.message.chat_id, query.message.message_id):
+        await query.edit_message_text("❌ Рассылка не найдена, ещё отправляется или уже удалена")
         return
     
     # Обновляем сообщение - показываем "удаление..."
     await query.edit_message_text("🔄 Удаление сообщений у пользователей...")
-    
-    deleted_count = 0
-    for user_id, message_id in broadcast_data['messages']:
-        try:
-            await context.bot.delete_message(chat_id=user_id, message_id=message_id)
-            deleted_count += 1
-        except Exception as e:
-            print(f"❌ Не удалось удалить у {user_id}: {e}")
-        await asyncio.sleep(0.1)
-    
-    await query.edit_message_text(
-        f"🗑️ Удалено {deleted_count} сообщений рассылки\n"
-        f"Текст: {broadcast_data['text']}"
+    ensure_broadcast_runner(context.bot)
+
+BROADCAST_STATUS_TEXT = {
+    'running': '🔄 отправляется',
+    'done': '✅ отправлена',
+    'failed': '❌ прервана',
+    'recalling': '🗑️ удаляется',
+    'recalled': '🗑️ удалена',
+    'recall_failed': '❌ удаление прервано',
+}
+
+async def cmd_broadcasts(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Последние рассылки с кнопкой удаления у получателей"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Доступ запрещён.")
+        return
+
+    broadcasts = await adb.list_broadcasts(10)
+    if not broadcasts:
+        await update.message.reply_text("📣 Рассылок ещё не было")
+        return
+
+    lines = ["📣 Последние рассылки:\n"]
+    keyboard = []
+    for broadcast_id, text, target, status, created_at, sent, total in broadcasts:
+        preview = text if len(text) <= 40 else text[:40] + "…"
+        lines.append(
+            f"#{broadcast_id} {created_at[:16]} — {BROADCAST_STATUS_TEXT.get(status, status)}\n"
+            f"🎯 {BROADCAST_AUDIENCE_TEXT.get(target, target)}, доставлено {sent or 0}/{total}\n{preview}\n"
+        )
+        if sent and status in ('done', 'failed', 'recall_failed'):
+            keyboard.append([InlineKeyboardButton(f"🗑️ Удалить #{broadcast_id} у всех",
+                                                  callback_data=f"broadcast_delete_{broadcast_id}")])
+
+    await update.message.reply_text(
+        "\n".join(lines), reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None,
     )
-    
-    # Очищаем данные
-    context.user_data.pop('last_broadcast', None)
-    
+
 async def show_barista_management(update: Update):
-    baristas = db.get_all_baristas()
+    baristas = await adb.get_all_baristas()
     text = "📜 Список барист:\n\n"
 
     if baristas:
@@ -785,7 +1156,7 @@ async def show_customer_management(update: Update):
     await update.message.reply_text(text, reply_markup=get_admin_customers_keyboard())
 async def show_all_customers(update: Update):
     print('[DEBUG] show_all_customers вызвана')
-    users = db.get_all_users()  # ← нужно добавить в database.py
+    users = await adb.get_all_users()  # ← нужно добавить в database.py
     promotion = db.get_promotion()
     required = promotion[2] if promotion else 7
 
@@ -834,7 +1205,7 @@ async def handle_admin_customer_management(update: Update, context: ContextTypes
     if text == "🔍 Найти пользователя":
         print("DEBUG: нажата кнопка Найти пользователя")   # ← и сюда
         set_user_state(context, 'finding_customer_by_username')
-        await update.message.reply_text("Введите @username гостя (без @):")
+        await update.message.reply_text("Введите @username, имя или номер гостя:")
         return
 
     # остальные elif...
@@ -904,11 +1275,11 @@ async def handle_customer_search(update: Update, context: ContextTypes.DEFAULT_T
         return
     
     # Ищем пользователя по username
-    user_data = db.get_user_by_username_exact(username_input)
+    user_data = await adb.get_user_by_username_exact(username_input)
     
     if user_data:
         customer_id, username, first_name, last_name = user_data
-        purchases = db.get_user_stats(customer_id)
+        purchases = await adb.get_user_stats(customer_id)
         promotion = db.get_promotion()
         required = promotion[2] if promotion else 7
         
@@ -984,20 +1355,56 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
     elif data.startswith('remove_'):
         customer_id = int(data.replace('remove_', ''))
         # Логика списания покупки
-        new_count = db.update_user_purchases(customer_id, -1)
+        new_count = await adb.update_user_purchases(customer_id, -1)
         await query.edit_message_text(f"✅ Покупка отменена. Новый счетчик: {new_count}")
         
     elif data == 'back_to_customers':
         set_user_state(context, 'admin_customers')
         await show_customer_management(update)
+
+    # Результаты поиска гостей
+    elif data.startswith('search_page_'):
+        search_query = context.user_data.get('search_query')
+        if search_query:
+            await show_search_results(update, context, search_query, offset=int(data.replace('search_page_', '')))
+
+    elif data.startswith('pick_'):
+        if not is_admin(query.from_user.id):
+            return
+        customer_id = int(data.replace('pick_', ''))
+        user_info = await adb.get_user_info(customer_id)
+        if user_info:
+            await show_admin_customer_card(update, context, (customer_id, *user_info[:3]))
+
+    elif data.startswith('scan_'):
+        role = get_user_role(query.from_user.id, query.from_user.username)
+        if role != 'barista' and not (role == 'admin' and get_user_state(context) == 'barista_mode'):
+            return
+        await process_customer_scan(update, context, int(data.replace('scan_', '')))
 # ================== БАЗОВЫЕ ФУНКЦИИ ==================
+qr_card_cache = QRCardCache()
+
 async def send_qr_code(update: Update, user_id: int):
-    qr_image = generate_qr_code(user_id)
     caption = "📱 Ваш персональный QR-код\n\nПокажите его баристе при заказе"
-    await update.message.reply_photo(photo=qr_image, caption=caption)
+
+    # Карточка уже загружалась в Telegram — отправляем по file_id без рендера и загрузки
+    card_key = card_cache_key()
+    file_id = await adb.get_qr_file_id(user_id, card_key)
+    if file_id:
+        try:
+            await update.message.reply_photo(photo=file_id, caption=caption)
+            return
+        except BadRequest as e:
+            print(f"⚠️ file_id карточки {user_id} недействителен: {e}")
+            await adb.delete_qr_file_id(user_id)
+
+    qr_image = await asyncio.to_thread(qr_card_cache.get, user_id)
+    sent = await update.message.reply_photo(photo=qr_image, caption=caption)
+    if sent.photo:
+        await adb.set_qr_file_id(user_id, card_key, sent.photo[-1].file_id)
 
 async def show_user_status(update: Update, user_id: int):
-    purchases = db.get_user_stats(user_id)
+    purchases = await adb.get_user_stats(user_id)
     promotion = db.get_promotion()
     required = promotion[2] if promotion else 7
     remaining = max(0, required - purchases)
@@ -1017,7 +1424,7 @@ async def show_promotion_info(update: Update):
     promotion = db.get_promotion()
     user = update.effective_user
     user_id = user.id
-    purchases = db.get_user_stats(user_id)
+    purchases = await adb.get_user_stats(user_id)
     required = promotion[2] if promotion else 7
 
     print(f"🔵 DEBUG: user_id={user_id}, purchases={purchases}, required={required}")
@@ -1120,11 +1527,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("💬 Для добавления отправь\nНОМЕР ИМЯ\nв формате как это:\n\n9996664422 Саша")
             return
         elif text == "✔ Начислить":
-            customer_id = context.user_data.get('current_customer')
-            if customer_id:
-                await process_coffee_purchase(update, context, customer_id)
-            else:
-                await update.message.reply_text("❌ Сначала найдите клиента по QR или номеру")
+            await credit_current_customer(update, context)
             return
         elif text == "🧾 Инфо":
             await show_barista_promotion_info(update)
@@ -1133,6 +1536,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         elif text in ["📲 Добавить номер", "✔ Начислить", "🧾 Инфо"]:
             # Эти кнопки уже обработаны выше
             pass
+        elif len(text.strip()) >= 3:
+            # Поиск гостя по имени, username или номеру: «Саша 4422»
+            await show_search_results(update, context, text.strip(), pick_prefix='scan_')
+            return
         else:
             # Показываем меню баристы для обычных барист в состоянии main
             await show_barista_main(update)
@@ -1162,11 +1569,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         elif text == "✔ Начислить":
             set_user_state(context, 'barista_mode')
-            customer_id = context.user_data.get('current_customer')
-            if customer_id:
-                await process_coffee_purchase(update, context, customer_id)
-            else:
-                await update.message.reply_text("❌ Сначала найдите клиента по QR или номеру")
+            await credit_current_customer(update, context)
             return
         elif text == "🧾 Инфо":
             set_user_state(context, 'barista_mode')
@@ -1186,7 +1589,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 name = parts[1].strip()
                 
                 if phone.isdigit() and len(phone) == 10:
-                    customer_id = db.find_user_by_phone(phone)
+                    customer_id = await adb.find_user_by_phone(phone)
                     
                     if customer_id:
                         await update.message.reply_text("✅ Найден клиент")
@@ -1196,8 +1599,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         import random
                         new_customer_id = random.randint(1000000000, 9999999999)
                         
-                        db.get_or_create_user(new_customer_id, "", name, "")
-                        db.update_user_phone(new_customer_id, phone)
+                        await adb.get_or_create_user(new_customer_id, "", name, "")
+                        await adb.update_user_phone(new_customer_id, phone)
                         
                         await update.message.reply_text(f"✅ Создан новый клиент: {name} ({phone})")
                         await asyncio.sleep(0.5)
@@ -1233,7 +1636,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if state == 'adding_barista':
         username_input = text.replace('@', '').strip()
         if username_input and username_input not in ['➕ Добавить', '➖ Удалить', '📋 Список', '🔙 Назад']:
-            if db.add_barista(username_input, "Бариста", ""):
+            if await adb.add_barista(username_input, "Бариста", ""):
                 await update.message.reply_text(f"✅ Бариста @{username_input} успешно добавлен!")
             else:
                 await update.message.reply_text("❌ Ошибка при добавлении баристы")
@@ -1246,7 +1649,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif state == 'removing_barista':
         username_input = text.replace('@', '').strip()
         if username_input and username_input not in ['➕ Добавить', '➖ Удалить', '📋 Список', '🔙 Назад']:
-            if db.remove_barista(username_input):
+            if await adb.remove_barista(username_input):
                 await update.message.reply_text(f"✅ Бариста @{username_input} успешно удален!")
             else:
                 await update.message.reply_text("❌ Бариста не найден")
@@ -1266,7 +1669,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             new_condition = int(text)
             if 1 <= new_condition <= 20:
-                db.update_promotion(required_purchases=new_condition)
+                await adb.update_promotion(required_purchases=new_condition)
                 await update.message.reply_text(f"✅ Условие акции изменено на {new_condition} покупок!")
             else:
                 await update.message.reply_text("❌ Число должно быть от 1 до 20")
@@ -1284,7 +1687,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     elif state == 'changing_promotion_description':
         if text and text not in ['📝 Название', 'Условие', '📖 Описание', '🔙 Назад']:
-            db.update_promotion(description=text)
+            await adb.update_promotion(description=text)
             await update.message.reply_text("✅ Описание акции успешно обновлено!")
             set_user_state(context, 'promotion_management')
             await show_promotion_management(update)
@@ -1293,7 +1696,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     elif state == 'changing_promotion_name':
         if text and text not in ['📝 Название', 'Условие', '📖 Описание', '🔙 Назад']:
-            db.update_promotion(name=text)
+            await adb.update_promotion(name=text)
             await update.message.reply_text("✅ Название акции обновлено!")
             set_user_state(context, 'promotion_management')
             await show_promotion_management(update)
@@ -1304,7 +1707,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             new_condition = int(text)
             if 1 <= new_condition <= 20:
-                db.update_promotion(required_purchases=new_condition)
+                await adb.update_promotion(required_purchases=new_condition)
                 await update.message.reply_text(f"✅ Условие акции изменено на {new_condition} покупок!")
                 set_user_state(context, 'promotion_management')
                 await show_promotion_management(update)
@@ -1320,17 +1723,13 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         elif text == "✔ Начислить":
             print(f"🟡 DEBUG: Обрабатываем +1, текущее состояние: {state}")
-            customer_id = context.user_data.get('current_customer')
-            if customer_id:
-                await process_coffee_purchase(update, context, customer_id)
-            else:
-                await update.message.reply_text("❌ Сначала найдите клиента по QR или номеру")
+            await credit_current_customer(update, context)
             return
         elif text == "📲 Добавить номер":  # ← ДОБАВЬ ЭТУ СТРОКУ
             set_user_state(context, 'adding_customer')
             await update.message.reply_text("💬 Для добавления отправь\nНОМЕР ИМЯ\nв формате как это:\n\n9996664422 Саша")
             return
-        elif " " in text:
+        elif " " in text and text.split(" ", 1)[0].strip().isdigit():
             try:
                 # Разделяем по первому пробелу: номер имя
                 parts = text.split(" ", 1)
@@ -1338,7 +1737,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 name = parts[1].strip()
                 
                 if phone.isdigit() and len(phone) == 10:
-                    customer_id = db.find_user_by_phone(phone)
+                    customer_id = await adb.find_user_by_phone(phone)
                     
                     if customer_id:
                         await update.message.reply_text("✅ Найден клиент")
@@ -1348,8 +1747,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         import random
                         new_customer_id = random.randint(1000000000, 9999999999)
                         
-                        db.get_or_create_user(new_customer_id, "", name, "")
-                        db.update_user_phone(new_customer_id, phone)
+                        await adb.get_or_create_user(new_customer_id, "", name, "")
+                        await adb.update_user_phone(new_customer_id, phone)
                         
                         await update.message.reply_text(f"✅ Создан новый клиент: {name} ({phone})")
                         await asyncio.sleep(0.5)
@@ -1364,13 +1763,16 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             except (ValueError, IndexError):
                 await update.message.reply_text("❌ Формат: номер имя\nПример: 9996664422 Саша")
         elif text.isdigit() and len(text) == 10:
-            customer_id = db.find_user_by_phone(text)
+            customer_id = await adb.find_user_by_phone(text)
             if customer_id:
                 await update.message.reply_text("✅ Найден клиент по номеру")
                 await asyncio.sleep(0.5)
                 await process_customer_scan(update, context, customer_id)
             else:
                 await update.message.reply_text(f"❌ Клиент с номером {text} не найден\n\nИспользуйте формат: 9996664422 Саша")
+        elif len(text.strip()) >= 3:
+            # Поиск гостя по имени, username или части номера: «Саша 4422»
+            await show_search_results(update, context, text.strip(), pick_prefix='scan_')
         else:
             await update.message.reply_text("📸 Отправьте фото QR или введите номер имя\nПример: 9996664422 Саша")
 
@@ -1380,14 +1782,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
             customer_id = context.user_data.get('current_customer')
             if customer_id:
-                new_count = db.update_user_purchases(customer_id, 1)
-                promotion = db.get_promotion()
-                required = promotion[2] if promotion else 7
-
-                # ДОБАВИТЬ: получаем имя клиента
-                cursor = db.conn.cursor()
-                cursor.execute('SELECT username, first_name, last_name FROM users WHERE user_id = ?', (customer_id,))
-                user_info = cursor.fetchone()
+                result = await adb.credit_purchase(customer_id, 1)
+                if result is None:
+                    await update.message.reply_text("❌ Ошибка: клиент не найден")
+                    return
+                new_count, required = result[0], result[1]
+
+                # имя клиента приходит вместе с новым счётчиком
+                user_info = result[2:]
             
                 username = user_info[0] if user_info and user_info[0] else "Не указан"
                 first_name = user_info[1] if user_info and user_info[1] else ""
@@ -1443,9 +1845,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
             customer_id = context.user_data.get('current_customer')
             if customer_id:
-                new_count = db.update_user_purchases(customer_id, -1)
-                promotion = db.get_promotion()
-                required = promotion[2] if promotion else 7
+                result = await adb.credit_purchase(customer_id, -1)
+                if result is None:
+                    await update.message.reply_text("❌ Ошибка: клиент не найден")
+                    return
+                new_count, required = result[0], result[1]
     
                 # ДОБАВЬТЕ ВИЗУАЛЬНЫЙ ПРОГРЕСС И ЗДЕСЬ
                 progress_bar = get_coffee_progress(new_count, required)
@@ -1470,17 +1874,12 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         customer_id = context.user_data.get('current_customer')
         print(f"[DEBUG] current_customer={customer_id}")
 
-        promotion = db.get_promotion()
-        required = promotion[2] if promotion else 7
-
         if text.startswith("➕"):
             print("[DEBUG] нажата кнопка ➕")
-            new_count = db.update_user_purchases(customer_id, 1)
-            print(f"[DEBUG] новый счётчик = {new_count}")
+            result = await adb.credit_purchase(customer_id, 1)
         elif text.startswith("➖"):
             print("[DEBUG] нажата кнопка ➖")
-            new_count = db.update_user_purchases(customer_id, -1)
-            print(f"[DEBUG] новый счётчик = {new_count}")
+            result = await adb.credit_purchase(customer_id, -1)
         elif text.startswith("🔙"):
             print("[DEBUG] нажата кнопка 🔙")
             set_user_state(context, 'admin_customers')
@@ -1490,6 +1889,12 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             print(f"[DEBUG] неизвестная кнопка: '{text}'")
             return
 
+        if result is None:
+            await update.message.reply_text("❌ Пользователь не найден.")
+            return
+        new_count, required = result[0], result[1]
+        print(f"[DEBUG] новый счётчик = {new_count}")
+
         # ⬇⬇⬇ ОБНОВЛЯЕМ карточку и ОСТАЁМСЯ ТУТ же ⬇⬇⬇
         name = f"@{context.user_data.get('current_username') or 'Гость'}"
         msg = f"✅ Обновлено!\n\n👤 {name}\n📊 Новый счётчик: {new_count}/{required}\n🎯 До подарка: {max(0, required - new_count)}"
@@ -1521,10 +1926,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         elif state == 'admin_customers':
             if text == "Найти пользователя":  # ← ПРОСТОЙ ТЕКСТ
                 set_user_state(context, 'finding_customer_by_username')
-                await update.message.reply_text("Введите @username пользователя (без @):")
+                await update.message.reply_text("Введите @username, имя или номер гостя:")
             elif text == "🔍 Найти пользователя":
                 set_user_state(context, 'finding_customer_by_username')
-                await update.message.reply_text("Введите @username пользователя (без @):")
+                await update.message.reply_text("Введите @username, имя или номер гостя:")
                 return
             elif text == "🔙 Назад":
                 set_user_state(context, 'main')
@@ -1561,6 +1966,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     "✍ Введите текст для рассылки:\n\n"
                     "!c только клиентам\n"
                     "!b только баристам\n"
+                    "!a покупавшим за последние 30 дней\n"
                     "без префикса - всем пользователям\n\n"
                 )
                 return
@@ -1612,9 +2018,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     user_id = update.effective_user.id
                 
                     # Обновляем имя и номер
-                    cursor = db.conn.cursor()
-                    cursor.execute('UPDATE users SET first_name = ?, phone = ? WHERE user_id = ?', (name, phone, user_id))
-                    db.conn.commit()
+                    await adb.update_user_profile(user_id, name, phone)
                 
                     await update.message.reply_text(f"✅ Ваш профиль обновлен: {name} ({phone}) теперь вы можете баристе называть номер при заказе")
                     set_user_state(context, 'client_mode')
@@ -1664,11 +2068,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Обрабатываем кнопки которые попали сюда
         if text == "✔ Начислить" and state == 'barista_mode':
-            customer_id = context.user_data.get('current_customer')
-            if customer_id:
-                await process_coffee_purchase(update, context, customer_id)
-            else:
-                await update.message.reply_text("❌ Сначала найдите клиента по QR или номеру")
+            await credit_current_customer(update, context)
         elif text == "🧾 Инфо" and state == 'barista_mode':
             await show_barista_promotion_info(update)
             return
@@ -1692,15 +2092,39 @@ async def cmd_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     try:
-        path = db.backup_db()  # создаём копию
-        await update.message.reply_document(
-            document=open(path, 'rb'),
-            caption=f"📦 Резервная копия БД\n📅 {datetime.datetime.now():%d.%m.%Y %H:%M}"
-        )
-        db.cleanup_old_backups(7)   # оставляем 7 последних копий
+        path = await asyncio.to_thread(db.backup_db)  # создаём копию вне event loop
+        with open(path, 'rb') as f:
+            await update.message.reply_document(
+                document=f,
+                caption=f"📦 Резервная копия БД\n📅 {datetime.datetime.now():%d.%m.%Y %H:%M}"
+            )
+        await asyncio.to_thread(db.cleanup_old_backups, 7)   # оставляем 7 последних копий
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка при создании бэкапа:\n{e}")
 
+async def cmd_qr_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Статистика этапов распознавания QR: сколько раз запускался, сколько раз нашёл, время"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Доступ запрещён.")
+        return
+
+    lines = ["📊 Распознавание QR по этапам:\n"]
+    for stage, stats in get_decode_stats().items():
+        calls = stats['calls']
+        avg_ms = stats['seconds'] / calls * 1000 if calls else 0
+        lines.append(f"{stage}: {stats['hits']}/{calls} успешно, ~{avg_ms:.0f} мс")
+    lines.append(f"\nКеш фото: {qr_scan_cache.hits} попаданий, {qr_scan_cache.misses} промахов")
+    await update.message.reply_text("\n".join(lines))
+
+async def scheduled_backup(context: ContextTypes.DEFAULT_TYPE):
+    """Ежедневный бэкап (JobQueue): копия + удаление старых, всё в отдельном потоке"""
+    try:
+        path = await asyncio.to_thread(db.backup_db)
+        await asyncio.to_thread(db.cleanup_old_backups, 7)
+        print(f"📦 Бэкап создан: {path}")
+    except Exception as e:
+        print(f"❌ Ошибка автоматического бэкапа: {e}")
+
 async def handle_barista_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     print("DEBUG callback triggered")   # ← должно появиться в консоли
     query = update.callback_query
@@ -1727,44 +2151,54 @@ async def handle_customer_by_username(update: Update, context: ContextTypes.DEFA
         return
 
     print("[DEBUG] 4. ищем в БД...")
-    user_data = db.get_user_by_username_exact(username_input)
+    user_data = await adb.get_user_by_username_exact(username_input)
     print(f"[DEBUG] 5. user_data = {user_data}")
 
     if user_data:
         print("[DEBUG] 6. user_data НЕ ПУСТОЙ – показываем карточку")
-        customer_id, username, first_name, last_name = user_data
-        purchases = db.get_user_stats(customer_id)
-        promotion = db.get_promotion()
-        required = promotion[2] if promotion else 7
+        await show_admin_customer_card(update, context, user_data)
+        return
 
-        # Приоритет: Имя Фамилия > username > Гость
-        # Обрабатываем случай когда last_name = "None" (строка)
-        clean_last_name = last_name if last_name and last_name != "None" else ""
-        user_display_name = f"{first_name} {clean_last_name}".strip()
-        if not user_display_name:
-            user_display_name = f"@{username}" if username else "Гость"
+    # Точного совпадения нет — ищем по имени, username и номеру
+    print("[DEBUG] 6. точного совпадения нет – полнотекстовый поиск")
+    await show_search_results(update, context, username_input, pick_prefix='pick_')
 
-        # Создаем прогресс-бар
-        progress_bar = get_coffee_progress(purchases, required)
 
-        if purchases >= required:
-            user_emoji = get_random_user_emoji()
-            text = f"""
+async def show_admin_customer_card(update: Update, context: ContextTypes.DEFAULT_TYPE, user_data):
+    """Карточка гостя для админа с кнопками начисления/отмены"""
+    customer_id, username, first_name, last_name = user_data
+    purchases = await adb.get_user_stats(customer_id)
+    promotion = db.get_promotion()
+    required = promotion[2] if promotion else 7
+
+    # Приоритет: Имя Фамилия > username > Гость
+    # Обрабатываем случай когда last_name = "None" (строка)
+    clean_last_name = last_name if last_name and last_name != "None" else ""
+    user_display_name = f"{first_name} {clean_last_name}".strip()
+    if not user_display_name:
+        user_display_name = f"@{username}" if username else "Гость"
+
+    # Создаем прогресс-бар
+    progress_bar = get_coffee_progress(purchases, required)
+
+    if purchases >= required:
+        user_emoji = get_random_user_emoji()
+        text = f"""
 {user_emoji} {user_display_name}
 
 {progress_bar}
 
 🎉 Бесплатный напиток доступен!
 """
+    else:
+        remaining = required - purchases - 1
+        user_emoji = get_random_user_emoji()
+        if remaining == 0:
+            status_text = "Следующий 🎁"
         else:
-            remaining = required - purchases - 1
-            user_emoji = get_random_user_emoji()
-            if remaining == 0:
-                status_text = "Следующий 🎁"
-            else:
-                status_text = f"Ещё {remaining}"
+            status_text = f"Ещё {remaining}"
     
-            text = f"""
+        text = f"""
 {user_emoji} {user_display_name}
 
 {progress_bar}
@@ -1772,23 +2206,67 @@ async def handle_customer_by_username(update: Update, context: ContextTypes.DEFA
 {status_text}
 """
 
-        keyboard = [
-            [KeyboardButton("➕ Начислить покупку")],
-            [KeyboardButton("➖ Отменить покупку")],
-            [KeyboardButton("🔙 Назад")]
-        ]
-        print("[DEBUG] 7. отправляю сообщение с клавиатурой")
-        await update.message.reply_text(text, reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
-
-        print("[DEBUG] 8. сохраняю customer_id и переключаю состояние")
-        context.user_data['current_customer'] = customer_id
-        context.user_data['current_username'] = username or f"{first_name} {last_name}".strip() or "Гость"
-        set_user_state(context, 'admin_customer_actions')
-        print("[DEBUG] 9. выходим из функции")
+    keyboard = [
+        [KeyboardButton("➕ Начислить покупку")],
+        [KeyboardButton("➖ Отменить покупку")],
+        [KeyboardButton("🔙 Назад")]
+    ]
+    print("[DEBUG] 7. отправляю сообщение с клавиатурой")
+    await update.effective_message.reply_text(text, reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+
+    print("[DEBUG] 8. сохраняю customer_id и переключаю состояние")
+    context.user_data['current_customer'] = customer_id
+    context.user_data.pop('current_customers', None)
+    context.user_data['current_username'] = username or f"{first_name} {last_name}".strip() or "Гость"
+    set_user_state(context, 'admin_customer_actions')
+    print("[DEBUG] 9. выходим из функции")
+
+
+SEARCH_PAGE_SIZE = 5
+
+async def show_search_results(update: Update, context: ContextTypes.DEFAULT_TYPE, search_query: str,
+                              offset: int = 0, pick_prefix: str = None):
+    """
+    Показывает страницу результатов поиска гостей инлайн-кнопками.
+    pick_prefix: 'pick_' — открыть карточку админа, 'scan_' — карточку баристы.
+    """
+    if pick_prefix:
+        context.user_data['search_query'] = search_query
+        context.user_data['search_pick'] = pick_prefix
+    pick_prefix = context.user_data.get('search_pick', 'pick_')
+
+    # берём на одну запись больше, чтобы понять, есть ли следующая страница
+    results = await adb.search_users(search_query, limit=SEARCH_PAGE_SIZE + 1, offset=offset)
+    has_more = len(results) > SEARCH_PAGE_SIZE
+    results = results[:SEARCH_PAGE_SIZE]
+
+    if not results:
+        await update.effective_message.reply_text("❌ Пользователь не найден.")
         return
 
-    print("[DEBUG] 6. user_data ПУСТОЙ – сообщаем 'не найден'")
-    await update.message.reply_text("❌ Пользователь не найден.")
+    keyboard = []
+    for customer_id, username, first_name, last_name, phone, purchases in results:
+        name = f"{first_name or ''} {last_name if last_name and last_name != 'None' else ''}".strip()
+        label = name or (f"@{username}" if username else "Гость")
+        if username and name:
+            label += f" @{username}"
+        if phone:
+            label += f" …{phone[-4:]}"
+        keyboard.append([InlineKeyboardButton(label, callback_data=f"{pick_prefix}{customer_id}")])
+
+    nav = []
+    if offset > 0:
+        nav.append(InlineKeyboardButton("⬅️", callback_data=f"search_page_{max(0, offset - SEARCH_PAGE_SIZE)}"))
+    if has_more:
+        nav.append(InlineKeyboardButton("➡️", callback_data=f"search_page_{offset + SEARCH_PAGE_SIZE}"))
+    if nav:
+        keyboard.append(nav)
+
+    text = f"🔎 Найдено по запросу «{search_query}»:"
+    if update.callback_query:
+        await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+    else:
+        await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Справка по командам - ТОЛЬКО для админа"""
@@ -1806,6 +2284,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 📋 Основные команды:
 /start - Главное меню
 /backup - Создать резервную копию БД  
+/qr_stats - Статистика распознавания QR
+/broadcasts - Последние рассылки и их удаление
 /sticker_id - Получить ID стикера
 /help - Эта справка
 
@@ -1829,13 +2309,42 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(text)
 # ================== ЗАПУСК ==================
 def main():
+    init_database()
+
     # Финальная инициализация для продакшена
-    application = Application.builder().token(BOT_TOKEN).build()
+    async def on_startup(app: Application):
+        global qr_decoder
+        qr_decoder = QRDecodePool(workers=QR_DECODE_WORKERS, max_queue=QR_DECODE_QUEUE, timeout=QR_DECODE_TIMEOUT)
+        get_card_template()  # фон и шрифты карточки готовим один раз при старте
+        # Карточки кодируют ссылку на бота, поэтому нужен его username
+        set_bot_username(app.bot.username)
+        # Частые запросы должны идти по индексам; если нет — схема разошлась с кодом
+        for name, (indexed, plan) in (await adb.check_query_plans()).items():
+            if not indexed:
+                print(f"⚠️ Запрос {name} идёт без индекса: {plan}")
+        # Рассылки и удаления, прерванные перезапуском, продолжаем с места остановки
+        if await adb.get_active_broadcasts():
+            ensure_broadcast_runner(app.bot)
+
+    async def on_shutdown(app: Application):
+        # Незаконченная рассылка останется в БД и продолжится после запуска
+        if broadcast_task and not broadcast_task.done():
+            broadcast_task.cancel()
+            try:
+                await broadcast_task
+            except asyncio.CancelledError:
+                pass
+        if qr_decoder is not None:
+            qr_decoder.close()
+
+    application = Application.builder().token(BOT_TOKEN).post_init(on_startup).post_shutdown(on_shutdown).build()
 
     # Все обработчики как должно быть в финальной версии
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("backup", cmd_backup))
+    application.add_handler(CommandHandler("qr_stats", cmd_qr_stats))
+    application.add_handler(CommandHandler("broadcasts", cmd_broadcasts))
     application.add_handler(CommandHandler("sticker_id", get_sticker_id))
     application.add_handler(CallbackQueryHandler(handle_callback_query))
     application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
@@ -1848,18 +2357,10 @@ def main():
     
     application.add_error_handler(error_handler)
 
-    # Бэкапы в фоне
-    import threading
-    def backup_job():
-        import schedule
-        import time
-        schedule.every().day.at("04:00").do(db.backup_db)
-        schedule.every().day.at("04:01").do(lambda: db.cleanup_old_backups(7))
-        while True:
-            schedule.run_pending()
-            time.sleep(60)
-    
-    threading.Thread(target=backup_job, daemon=True).start()
+    # Бэкапы каждый день в 04:00 по местному времени через JobQueue бота
+    local_tz = datetime.datetime.now().astimezone().tzinfo
+    application.job_queue.run_daily(scheduled_backup, time=datetime.time(hour=4, minute=0, tzinfo=local_tz),
+                                    name='daily_backup')
 
     print("🚀 Бот запускается на продакшене...")
     application.run_polling()
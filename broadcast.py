@@ -0,0 +1,199 @@
+"""
+Рассылка (и удаление разосланного) с ограничением скорости.
+
+Telegram пропускает около 30 сообщений в секунду на бота, при превышении
+отвечает RetryAfter. Поэтому:
+  - TokenBucket — общий для всех отправок лимит сообщений в секунду;
+  - Broadcaster — несколько одновременных отправок (concurrency), каждая
+    берёт токен из корзины; RetryAfter ставит на паузу всю корзину,
+    а не одну отправку, и сообщение повторяется.
+Отправка, оборвавшаяся по таймауту или сети после ухода запроса, могла дойти,
+поэтому её не повторяем: иначе получатель увидит сообщение дважды.
+"""
+import asyncio
+import time
+
+import httpx
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+
+class TokenBucket:
+    """Не больше rate операций в секунду, всплеск до capacity"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Никто не получит токен ближайшие seconds секунд (ответ RetryAfter)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+# Постоянные причины: такому пользователю больше не пишем, пока он сам не вернётся в бота
+PERMANENT_FAILURES = ('blocked', 'deactivated', 'chat_not_found')
+
+
+def classify_delivery_error(error):
+    """
+    Причина неудачной отправки: blocked, deactivated, chat_not_found —
+    постоянные; transient — сеть и лимиты, имеет смысл повторить; error — прочее.
+    """
+    message = str(error).lower()
+    if isinstance(error, Forbidden):
+        if 'deactivated' in message:
+            return 'deactivated'
+        if 'blocked' in message or 'kicked' in message:
+            return 'blocked'
+        if "can't initiate conversation" in message:
+            return 'chat_not_found'  # пользователь ни разу не запускал бота
+        return 'error'
+    if isinstance(error, BadRequest):
+        if 'chat not found' in message or 'user not found' in message:
+            return 'chat_not_found'
+        return 'error'
+    if isinstance(error, (RetryAfter, TimedOut, NetworkError)):
+        return 'transient'
+    return 'error'
+
+
+def request_not_sent(error):
+    """
+    Сетевая ошибка случилась до отправки запроса (не удалось соединиться,
+    нет свободного соединения в пуле) — Telegram его не получал, повтор безопасен.
+    """
+    return isinstance(error.__cause__, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+
+def outcome_unknown(error):
+    """Запрос мог дойти до Telegram, но ответа нет (таймаут, обрыв соединения)"""
+    return (isinstance(error, (TimedOut, NetworkError)) and not isinstance(error, BadRequest)
+            and not request_not_sent(error))
+
+
+def _retry_after_seconds(error):
+    retry_after = error.retry_after
+    if hasattr(retry_after, 'total_seconds'):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class Broadcaster:
+    """
+    Выполняет вызов API для каждого элемента списка (отправка рассылки,
+    удаление её сообщений): concurrency вызовов одновременно, не быстрее
+    rate в секунду. RetryAfter повторяется до max_retries раз, сетевые ошибки —
+    только если запрос не ушёл (request_not_sent) или вызов идемпотентен
+    (удаление сообщения). Остальные ошибки (бот заблокирован, чат не найден) — нет.
+    """
+
+    def __init__(self, bot, rate=25, concurrency=8, max_retries=3):
+        self.bot = bot
+        # без всплесков: сообщения идут равномерно, лимит Telegram считается по секундам
+        self.bucket = TokenBucket(rate, capacity=1)
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+
+    async def _call(self, call, item, idempotent=False):
+        """Один вызов API с учётом лимита и повторов; возвращает результат или бросает ошибку"""
+        attempt = 0
+        while True:
+            await self.bucket.acquire()
+            try:
+                return await call(item)
+            except RetryAfter as e:
+                seconds = _retry_after_seconds(e)
+                print(f"⏳ RetryAfter {seconds} с ({item})")
+                self.bucket.pause(seconds)
+                error = e
+            except (Forbidden, BadRequest):
+                raise
+            except (TimedOut, NetworkError) as e:
+                if not idempotent and outcome_unknown(e):
+                    raise  # запрос мог дойти, повтор отправки дал бы дубль
+                print(f"⚠️ Сетевая ошибка для {item}: {e}")
+                await asyncio.sleep(2 ** attempt)
+                error = e
+            attempt += 1
+            if attempt > self.max_retries:
+                raise error
+
+    async def run(self, items, call, on_result=None, on_progress=None, progress_every=2.0, idempotent=False):
+        """
+        Выполняет await call(item) для каждого элемента items
+        (обычный или асинхронный итератор: id чатов, пары (чат, сообщение) и т.п.).
+        idempotent=True — повтор call безопасен, сетевые ошибки можно повторять.
+        on_result(item, результат или None, ошибка или None) — после каждого элемента,
+        on_progress(stats) — не чаще раза в progress_every секунд.
+        Возвращает stats: {'total', 'ok', 'failed'}.
+        """
+        stats = {'total': 0, 'ok': 0, 'failed': 0}
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        last_progress = time.monotonic()
+
+        async def worker():
+            nonlocal last_progress
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                result = error = None
+                try:
+                    result = await self._call(call, item, idempotent)
+                    stats['ok'] += 1
+                except Exception as e:
+                    error = e
+                    stats['failed'] += 1
+                    print(f"❌ Рассылка: ошибка для {item}: {e}")
+                try:
+                    if on_result:
+                        await on_result(item, result, error)
+                    if on_progress and time.monotonic() - last_progress >= progress_every:
+                        last_progress = time.monotonic()
+                        await on_progress(dict(stats))
+                except Exception as e:
+                    # ошибка учёта не должна останавливать рассылку
+                    print(f"❌ Ошибка обработки результата рассылки для {item}: {e}")
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            if hasattr(items, '__aiter__'):
+                async for item in items:
+                    stats['total'] += 1
+                    await queue.put(item)
+            else:
+                for item in items:
+                    stats['total'] += 1
+                    await queue.put(item)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+        return stats
+
+    async def delete_messages(self, pairs, **kwargs):
+        """Удаление сообщений по парам (chat_id, message_id); kwargs как у run()"""
+        return await self.run(
+            pairs, lambda pair: self.bot.delete_message(chat_id=pair[0], message_id=pair[1]),
+            idempotent=True, **kwargs,
+        )
@@ -15,6 +15,25 @@ for part in str(admin_ids_env).replace(' ', '').split(','):
         except ValueError:
             pass
 
+# Хранилище: DB_WAL=1 включает режим WAL с пулом читателей и одним писателем
+DB_WAL = os.getenv('DB_WAL', '0') == '1'
+DB_READERS = int(os.getenv('DB_READERS', '4'))
+# Групповой коммит (только с DB_WAL=1): окно в мс и максимум операций в одном COMMIT
+DB_GROUP_COMMIT_MS = int(os.getenv('DB_GROUP_COMMIT_MS', '0'))
+DB_GROUP_COMMIT_MAX = int(os.getenv('DB_GROUP_COMMIT_MAX', '64'))
+
+# Распознавание QR: число процессов, длина очереди и таймаут на одно фото (сек)
+QR_DECODE_WORKERS = int(os.getenv('QR_DECODE_WORKERS', '2'))
+QR_DECODE_QUEUE = int(os.getenv('QR_DECODE_QUEUE', '8'))
+QR_DECODE_TIMEOUT = float(os.getenv('QR_DECODE_TIMEOUT', '10'))
+# Кеш распознанных фото по file_unique_id: сколько фото помнить и сколько секунд
+QR_SCAN_CACHE_SIZE = int(os.getenv('QR_SCAN_CACHE_SIZE', '512'))
+QR_SCAN_CACHE_TTL = int(os.getenv('QR_SCAN_CACHE_TTL', '600'))
+
+# Рассылка: сообщений в секунду на весь бот и одновременных отправок
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '8'))
+
 if not BOT_TOKEN:
     raise ValueError("❌ BOT_TOKEN не найден в .env файле!")
 
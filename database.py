@@ -1,212 +1,910 @@
 import sqlite3
 from datetime import datetime
-import shutil, os
+import os
 from pathlib import Path
+import asyncio
+import functools
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import NamedTuple, Optional
 
-class Database:
-    def __init__(self, db_name='coffee_bot.db'):
-        self.conn = sqlite3.connect(db_name, check_same_thread=False)
-        self.create_tables()
-        self.update_database_schema()  # ← ДОБАВЬ ЭТУ СТРОКУ
 
-    def create_tables(self):
-        cursor = self.conn.cursor()
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                phone TEXT,
-                purchases_count INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Баристы
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS baristas (
-                username TEXT PRIMARY KEY,
-                first_name TEXT,
-                last_name TEXT,
-                is_active BOOLEAN DEFAULT 1,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Настройки акции
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS promotions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT DEFAULT 'Каждый 7-й напиток бесплатно',
-                required_purchases INTEGER DEFAULT 7,
-                description TEXT,
-                is_active BOOLEAN DEFAULT 1
-            )
+def normalize_phone(phone) -> Optional[str]:
+    """
+    Канонический вид номера для поиска: только цифры, без ведущей 7/8.
+    '+7 (999) 666-44-22', '89996664422' и '9996664422' -> '9996664422'
+    """
+    if not phone:
+        return None
+    digits = ''.join(filter(str.isdigit, str(phone)))
+    if len(digits) == 11 and digits[0] in '78':
+        digits = digits[1:]
+    return digits or None
+
+
+# === МИГРАЦИИ СХЕМЫ ===
+# Каждая миграция выполняется ровно один раз в своей транзакции, номер
+# последней применённой хранится в PRAGMA user_version. Новую миграцию
+# добавляем в конец MIGRATIONS со следующим номером, старые не меняем.
+
+def _migration_1(conn):
+    """Базовые таблицы (совместимо с базами, созданными до миграций)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            phone TEXT,
+            purchases_count INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Баристы
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS baristas (
+            username TEXT PRIMARY KEY,
+            first_name TEXT,
+            last_name TEXT,
+            is_active BOOLEAN DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Настройки акции
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS promotions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT DEFAULT 'Каждый 7-й напиток бесплатно',
+            required_purchases INTEGER DEFAULT 7,
+            description TEXT,
+            is_active BOOLEAN DEFAULT 1
+        )
+    ''')
+    # Администраторы (дополнительно к .env)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS admins (
+            user_id INTEGER PRIMARY KEY,
+            is_active BOOLEAN DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Старые базы без поля phone
+    columns = [column[1] for column in conn.execute('PRAGMA table_info(users)')]
+    if 'phone' not in columns:
+        conn.execute('ALTER TABLE users ADD COLUMN phone TEXT')
+    # Акция по умолчанию, только если акций ещё нет
+    if not conn.execute('SELECT 1 FROM promotions LIMIT 1').fetchone():
+        conn.execute('''
+            INSERT INTO promotions (name, required_purchases, description)
+            VALUES ('Каждый 7-й напиток бесплатно', 7, 'Покажите QR-код при каждой покупке')
         ''')
 
-        # Администраторы (дополнительно к .env)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS admins (
-                user_id INTEGER PRIMARY KEY,
-                is_active BOOLEAN DEFAULT 1,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+
+def _migration_2(conn):
+    """Нормализованный телефон и индексы для поиска по телефону и username"""
+    columns = [column[1] for column in conn.execute('PRAGMA table_info(users)')]
+    if 'phone_norm' not in columns:
+        conn.execute('ALTER TABLE users ADD COLUMN phone_norm TEXT')
+    rows = conn.execute('SELECT user_id, phone FROM users WHERE phone IS NOT NULL').fetchall()
+    conn.executemany('UPDATE users SET phone_norm = ? WHERE user_id = ?',
+                     [(normalize_phone(phone), user_id) for user_id, phone in rows])
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_phone_norm ON users(phone_norm)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)')
+
+
+def _migration_3(conn):
+    """Полнотекстовый индекс для поиска гостей (FTS5, триграммы)"""
+    try:
+        conn.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+                username, first_name, last_name, phone_norm,
+                content='users', content_rowid='user_id', tokenize='trigram'
             )
         ''')
-        
-        # Добавляем акцию по умолчанию
-        cursor.execute('''
-            INSERT OR IGNORE INTO promotions (name, required_purchases, description) 
-            VALUES ('Каждый 7-й напиток бесплатно', 7, 'Покажите QR-код при каждой покупке')
-        ''')
-        
-        self.conn.commit()
+    except sqlite3.OperationalError as e:
+        # SQLite собран без FTS5 или без trigram — поиск останется на LIKE
+        print(f"⚠️ Поисковый индекс недоступен: {e}")
+        return
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_fts_ai AFTER INSERT ON users BEGIN
+            INSERT INTO users_fts(rowid, username, first_name, last_name, phone_norm)
+            VALUES (new.user_id, new.username, new.first_name, new.last_name, new.phone_norm);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_fts_ad AFTER DELETE ON users BEGIN
+            INSERT INTO users_fts(users_fts, rowid, username, first_name, last_name, phone_norm)
+            VALUES ('delete', old.user_id, old.username, old.first_name, old.last_name, old.phone_norm);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_fts_au AFTER UPDATE OF username, first_name, last_name, phone_norm ON users BEGIN
+            INSERT INTO users_fts(users_fts, rowid, username, first_name, last_name, phone_norm)
+            VALUES ('delete', old.user_id, old.username, old.first_name, old.last_name, old.phone_norm);
+            INSERT INTO users_fts(rowid, username, first_name, last_name, phone_norm)
+            VALUES (new.user_id, new.username, new.first_name, new.last_name, new.phone_norm);
+        END
+    ''')
+    conn.execute("INSERT INTO users_fts(users_fts) VALUES ('rebuild')")
+
+
+def _migration_4(conn):
+    """file_id отправленных карточек QR, чтобы не загружать их повторно (card_key — см. card_cache_key)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS qr_file_ids (
+            user_id INTEGER PRIMARY KEY,
+            card_key TEXT NOT NULL,
+            file_id TEXT NOT NULL
+        )
+    ''')
+
+
+def _migration_5(conn):
+    """Время последней покупки для сегментов рассылки"""
+    columns = [column[1] for column in conn.execute('PRAGMA table_info(users)')]
+    if 'last_purchase_at' not in columns:
+        conn.execute('ALTER TABLE users ADD COLUMN last_purchase_at TIMESTAMP')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_last_purchase ON users(last_purchase_at)')
+
+
+def _migration_6(conn):
+    """Рассылки как задания с отметкой по каждому получателю"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            target TEXT NOT NULL,
+            admin_id INTEGER,
+            chat_id INTEGER,
+            status_message_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'running',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+    # status: pending → sending → sent/failed; sending после перезапуска → unknown
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            broadcast_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            message_id INTEGER,
+            error TEXT,
+            PRIMARY KEY (broadcast_id, user_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts(status)')
+
+
+def _migration_7(conn):
+    """Недоступные пользователи (заблокировали бота, удалили аккаунт)"""
+    columns = [column[1] for column in conn.execute('PRAGMA table_info(users)')]
+    if 'unreachable' not in columns:
+        conn.execute('ALTER TABLE users ADD COLUMN unreachable TEXT')
+    if 'unreachable_at' not in columns:
+        conn.execute('ALTER TABLE users ADD COLUMN unreachable_at TIMESTAMP')
+
+
+MIGRATIONS = [
+    (1, 'базовые таблицы', _migration_1),
+    (2, 'phone_norm и индексы поиска', _migration_2),
+    (3, 'поисковый индекс users_fts', _migration_3),
+    (4, 'кеш file_id карточек QR', _migration_4),
+    (5, 'last_purchase_at для сегментов рассылки', _migration_5),
+    (6, 'задания рассылки', _migration_6),
+    (7, 'недоступные пользователи', _migration_7),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+# Сегменты рассылки: условие WHERE для users. Роли считаются так же,
+# как в get_user_role: админ (.env или admins) > бариста (по username) > клиент.
+# {admins} подставляется списком плейсхолдеров для админов из .env.
+_IS_ADMIN = '(user_id IN ({admins}) OR user_id IN (SELECT user_id FROM admins WHERE is_active = 1))'
+_IS_BARISTA = 'username IN (SELECT username FROM baristas WHERE is_active = 1 AND username IS NOT NULL)'
+AUDIENCE_SEGMENTS = {
+    'all': '1',
+    'baristas': f'NOT {_IS_ADMIN} AND {_IS_BARISTA}',
+    'clients': f'NOT {_IS_ADMIN} AND (username IS NULL OR NOT {_IS_BARISTA})',
+    'active30': "last_purchase_at >= datetime('now', '-30 days')",
+}
+
+
+def write_op(build):
+    """
+    Метод записи, который только строит операцию fn(conn) для писателя.
+    Обычный вызов выполняет её через _write и возвращает результат;
+    AsyncDatabase ставит её в очередь писателя и ждёт COMMIT через Future,
+    не занимая поток пула (иначе пачка группового коммита не больше пула).
+    """
+    @functools.wraps(build)
+    def method(self, *args, **kwargs):
+        return self._write(build(self, *args, **kwargs))
+
+    method.build_op = build
+    return method
+
+
+class Promotion(NamedTuple):
+    """
+    Неизменяемый снимок активной акции. Порядок полей совпадает со строкой
+    таблицы promotions, поэтому promotion[2] по-прежнему required_purchases.
+    version увеличивается при каждом update_promotion.
+    """
+    id: int
+    name: str
+    required_purchases: int
+    description: Optional[str]
+    is_active: int
+    version: int = 0
+
+
+class DatabaseWriter(threading.Thread):
+    """
+    Единственный поток-писатель: берёт операции из очереди и выполняет их
+    на своём соединении.
+
+    Групповой коммит: операции, пришедшие в течение batch_ms (но не больше
+    batch_max штук), выполняются в одной транзакции и фиксируются одним
+    COMMIT. Каждая операция обёрнута в SAVEPOINT, поэтому ошибка в одной
+    не откатывает остальные. Future каждой операции завершается после COMMIT.
+    Попадёт ли запись на диск сразу, решает PRAGMA synchronous (см. Database):
+    при FULL каждый COMMIT — это fsync, и пачка экономит fsync'и; при NORMAL
+    в WAL COMMIT не делает fsync, и последние транзакции могут пропасть
+    при отключении питания (но не при падении процесса).
+    batch_max=1 — без группировки, каждая операция в своей транзакции.
+    """
+
+    def __init__(self, conn, batch_ms=0, batch_max=1):
+        super().__init__(name='db-writer', daemon=True)
+        self.conn = conn
+        self.queue = queue.Queue()
+        self.batch_ms = batch_ms
+        self.batch_max = max(1, batch_max)
+        self.stats = {'batches': 0, 'ops': 0}
+
+    def submit(self, fn) -> Future:
+        """Ставит fn(conn) в очередь, возвращает Future с результатом"""
+        future = Future()
+        self.queue.put((fn, future))
+        return future
+
+    def _collect_batch(self):
+        """Ждёт первую операцию и добирает к ней остальные в пределах окна"""
+        batch = [self.queue.get()]
+        if batch[0][0] is None:
+            return batch
+        deadline = time.monotonic() + self.batch_ms / 1000
+        while len(batch) < self.batch_max:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(item)
+            if item[0] is None:
+                break
+        return batch
+
+    def _commit_batch(self, batch):
+        conn = self.conn
+        results = []
+        conn.execute('BEGIN')
+        for fn, future in batch:
+            try:
+                conn.execute('SAVEPOINT op')
+                result = fn(conn)
+                conn.execute('RELEASE op')
+            except Exception as e:
+                conn.execute('ROLLBACK TO op')
+                conn.execute('RELEASE op')
+                results.append((future, None, e))
+            else:
+                results.append((future, result, None))
+
+        try:
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            results = [(future, None, e) for future, _, _ in results]
+
+        self.stats['batches'] += 1
+        self.stats['ops'] += len(batch)
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def run(self):
+        while True:
+            batch = self._collect_batch()
+            stop = batch[-1][0] is None
+            if stop:
+                batch.pop()
+            if batch:
+                self._commit_batch(batch)
+            if stop:
+                break
+
+    def stop(self):
+        self.queue.put((None, None))
+        self.join()
+
+
+class Database:
+    def __init__(self, db_name='coffee_bot.db', wal=False, readers=4, group_commit_ms=0, group_commit_max=64,
+                 admin_ids=()):
+        """
+        wal=False — как раньше: одно соединение, все запросы по очереди.
+        wal=True  — режим WAL: пул из readers соединений только для чтения
+                    и один писатель, которому операции передаются через очередь.
+        group_commit_ms > 0 — групповой коммит записей (только вместе с wal=True):
+                    писатель копит операции до group_commit_ms миллисекунд
+                    или group_commit_max штук и фиксирует их одним COMMIT.
+                    В этом режиме synchronous=FULL: каждый COMMIT доходит
+                    до диска, а fsync делается один на пачку. Без группировки —
+                    synchronous=NORMAL: COMMIT без fsync, завершённая запись
+                    переживёт падение процесса, но не отключение питания.
+        admin_ids — администраторы из конфига (.env), учитываются в get_user_role.
+        """
+        if group_commit_ms and not wal:
+            raise ValueError("Групповой коммит работает только в режиме WAL (wal=True)")
+        self.db_name = db_name
+        self.wal = wal
+        self.conn = sqlite3.connect(db_name, check_same_thread=False)
+        self._lock = threading.RLock()
+        if wal:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute(f"PRAGMA synchronous={'FULL' if group_commit_ms else 'NORMAL'}")
+        self.migrate()
+        self.fts_enabled = self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'users_fts'").fetchone() is not None
+
+        self._readers = None
+        self._writer = None
+        if wal:
+            self._readers = queue.Queue()
+            for _ in range(max(1, readers)):
+                self._readers.put(self._connect_reader())
+            if group_commit_ms:
+                self._writer = DatabaseWriter(self.conn, group_commit_ms, group_commit_max)
+            else:
+                self._writer = DatabaseWriter(self.conn)
+            self._writer.start()
+
+        # Индекс ролей в памяти: загружается один раз, дальше обновляется
+        # методами add/remove_barista и add/remove_admin. Запись в БД и замена
+        # множества идут под одной блокировкой и только после успешного COMMIT,
+        # иначе параллельные изменения могли бы оставить устаревший индекс.
+        self._roles_lock = threading.Lock()
+        self.config_admin_ids = frozenset(admin_ids)
+        self._load_roles()
+
+        # Снимок активной акции: читается без SQL, заменяется целиком в update_promotion
+        self._promotion_lock = threading.Lock()
+        self._promotion = None
+        self._reload_promotion()
+
+    def _connect_reader(self):
+        path = Path(self.db_name).resolve().as_posix()
+        conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+        conn.execute('PRAGMA query_only=1')
+        return conn
+
+    # === ВНУТРЕННИЕ ПОМОЩНИКИ ===
+    def _read(self, sql, params=(), one=False):
+        """Выполняет SELECT: в режиме WAL — на свободном соединении из пула"""
+        if self._readers is None:
+            with self._lock:
+                cursor = self.conn.execute(sql, params)
+                return cursor.fetchone() if one else cursor.fetchall()
+
+        conn = self._readers.get()
+        try:
+            cursor = conn.execute(sql, params)
+            return cursor.fetchone() if one else cursor.fetchall()
+        finally:
+            self._readers.put(conn)
+
+    def _write(self, fn):
+        """
+        Выполняет fn(conn) в одной транзакции и возвращает её результат.
+        В режиме WAL операция уходит в очередь писателя.
+        """
+        if self._writer is None:
+            with self._lock:
+                try:
+                    result = fn(self.conn)
+                    self.conn.commit()
+                except Exception:
+                    self.conn.rollback()
+                    raise
+                return result
+        return self.submit_write(fn).result()
+
+    def submit_write(self, fn) -> Future:
+        """
+        Ставит fn(conn) в очередь писателя и сразу возвращает Future,
+        который завершится после COMMIT (о fsync — см. DatabaseWriter).
+        Без WAL выполняет fn сразу, в вызывающем потоке.
+        """
+        if self._writer is None:
+            future = Future()
+            try:
+                future.set_result(self._write(fn))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        return self._writer.submit(fn)
+
+    def _execute(self, sql, params=()):
+        """Одиночный запрос на запись, возвращает rowcount"""
+        return self._write(lambda conn: conn.execute(sql, params).rowcount)
+
+    def migrate(self):
+        """
+        Применяет недостающие миграции по порядку. Если схема уже актуальна,
+        стоит один PRAGMA user_version и никаких проверок DDL.
+        """
+        current = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        if current >= SCHEMA_VERSION:
+            return
+
+        for version, description, fn in MIGRATIONS:
+            if version <= current:
+                continue
+            self.conn.execute('BEGIN')
+            try:
+                fn(self.conn)
+                self.conn.execute(f'PRAGMA user_version = {version}')
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            print(f"✅ Миграция {version}: {description}")
         print("✅ База данных инициализирована")
 
+    def close(self):
+        if self._writer is not None:
+            self._writer.stop()
+        if self._readers is not None:
+            while not self._readers.empty():
+                self._readers.get().close()
+        self.conn.close()
+
+    @write_op
     def update_user_phone(self, user_id, phone):
-        cursor = self.conn.cursor()
-        cursor.execute('UPDATE users SET phone = ? WHERE user_id = ?', (phone, user_id))
-        self.conn.commit()
-        return cursor.rowcount > 0
+        return lambda conn: conn.execute('UPDATE users SET phone = ?, phone_norm = ? WHERE user_id = ?',
+                                         (phone, normalize_phone(phone), user_id)).rowcount > 0
     
     # === ПОЛЬЗОВАТЕЛИ ===
     def get_or_create_user(self, user_id, username="", first_name="", last_name=""):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        user = cursor.fetchone()
+        user = self._read('SELECT unreachable FROM users WHERE user_id = ?', (user_id,), one=True)
         
         if not user:
-            cursor.execute('''
-                INSERT INTO users (user_id, username, first_name, last_name) 
+            self._execute('''
+                INSERT OR IGNORE INTO users (user_id, username, first_name, last_name) 
                 VALUES (?, ?, ?, ?)
             ''', (user_id, username, first_name, last_name))
-            self.conn.commit()
+        elif user[0]:
+            # Пользователь снова написал боту — значит, он снова доступен
+            self.set_user_unreachable(user_id, None)
         return user_id
 
+    @write_op
+    def set_user_unreachable(self, user_id, reason):
+        """reason: blocked, deactivated, chat_not_found; None — снова доступен"""
+        return lambda conn: conn.execute('''
+            UPDATE users SET unreachable = ?, unreachable_at = CASE WHEN ? IS NULL THEN NULL ELSE CURRENT_TIMESTAMP END
+            WHERE user_id = ?
+        ''', (reason, reason, user_id)).rowcount
+
+    def is_user_unreachable(self, user_id):
+        row = self._read('SELECT unreachable FROM users WHERE user_id = ?', (user_id,), one=True)
+        return bool(row and row[0])
+
+    def get_user_info(self, user_id):
+        """Возвращает (username, first_name, last_name, phone) или None"""
+        return self._read('SELECT username, first_name, last_name, phone FROM users WHERE user_id = ?', (user_id,), one=True)
+
+    @write_op
+    def update_user_profile(self, user_id, first_name, phone):
+        """Обновляет имя и номер телефона пользователя"""
+        return lambda conn: conn.execute('UPDATE users SET first_name = ?, phone = ?, phone_norm = ? WHERE user_id = ?',
+                                         (first_name, phone, normalize_phone(phone), user_id)).rowcount > 0
+
     def get_user_stats(self, user_id):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT purchases_count FROM users WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
+        result = self._read('SELECT purchases_count FROM users WHERE user_id = ?', (user_id,), one=True)
         return result[0] if result else 0
-    def update_user_purchases(self, user_id, change):
-        """Изменяет счётчик покупок с авто-обнулением при достижении акции"""
+    @write_op
+    def credit_purchase(self, user_id, change):
+        """
+        Атомарно изменяет счётчик покупок одним запросом.
+        При +1 и достижении условия акции счётчик обнуляется, ниже нуля не опускается.
+        Возвращает (new_count, required, username, first_name, last_name)
+        или None, если пользователя нет.
+        """
         promo = self.get_promotion()
-        required = promo[2] if promo else 7
+        required = promo.required_purchases if promo else 7
 
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT purchases_count FROM users WHERE user_id = ?', (user_id,))
-        current = cursor.fetchone()[0]
-    
-        new_val = current + change
-    
-    # Сброс при достижении точного значения required
-        if change == +1 and new_val >= required:
-            new_val = 0
-    
-        new_val = max(0, new_val)  # Защита от отрицательных значений
-    
-        cursor.execute('UPDATE users SET purchases_count = ? WHERE user_id = ?', (new_val, user_id))
-        self.conn.commit()
-        return new_val
+        return lambda conn: self._credit_row(conn, user_id, change, required)
+
+    @staticmethod
+    def _credit_row(conn, user_id, change, required):
+        row = conn.execute('''
+            UPDATE users SET purchases_count = CASE
+                WHEN :change > 0 AND purchases_count + :change >= :required THEN 0
+                ELSE MAX(0, purchases_count + :change)
+            END,
+            last_purchase_at = CASE WHEN :change > 0 THEN CURRENT_TIMESTAMP ELSE last_purchase_at END
+            WHERE user_id = :user_id
+            RETURNING purchases_count, username, first_name, last_name
+        ''', {'change': change, 'required': required, 'user_id': user_id}).fetchone()
+        return (row[0], required) + tuple(row[1:]) if row else None
+
+    @write_op
+    def credit_purchases(self, user_ids, change=1):
+        """
+        То же, что credit_purchase, но для нескольких клиентов в одной транзакции
+        (групповой заказ по одному фото). Возвращает {user_id: результат credit_purchase};
+        клиентов, которых нет в базе, в словаре нет.
+        """
+        promo = self.get_promotion()
+        required = promo.required_purchases if promo else 7
+
+        def op(conn):
+            results = {}
+            for user_id in dict.fromkeys(user_ids):
+                result = self._credit_row(conn, user_id, change, required)
+                if result:
+                    results[user_id] = result
+            return results
+
+        return op
+
+    def update_user_purchases(self, user_id, change):
+        """Изменяет счётчик покупок с авто-обнулением при достижении акции"""
+        result = self.credit_purchase(user_id, change)
+        return result[0] if result else 0
 
     def search_user_by_username(self, username):
         """Поиск пользователя по username"""
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE username LIKE ?', (f'%{username}%',))
-        return cursor.fetchall()
+        if self.fts_enabled and len(username.strip()) >= 3:
+            return self._read('''
+                SELECT users.* FROM users_fts JOIN users ON users.user_id = users_fts.rowid
+                WHERE users_fts MATCH ? ORDER BY rank
+            ''', ('username : ' + self._fts_phrase(username.strip()),))
+        return self._read('SELECT * FROM users WHERE username LIKE ?', (f'%{username}%',))
+
+    @staticmethod
+    def _fts_phrase(term):
+        return '"' + term.replace('"', '""') + '"'
+
+    def search_users(self, query, limit=10, offset=0):
+        """
+        Поиск гостей по username, имени, фамилии и телефону через FTS5 (trigram).
+        Каждое слово запроса ищется как подстрока: «Саша 4422» найдёт Сашу
+        с номером на ...4422. Если точных совпадений нет — нечёткий поиск
+        по общим триграммам. Результаты отсортированы по релевантности.
+        Возвращает список (user_id, username, first_name, last_name, phone, purchases_count).
+        """
+        terms = [t.lstrip('@') for t in query.split()]
+        terms = [normalize_phone(t) if t.isdigit() else t for t in terms]
+        terms = [t for t in terms if t]
+        if not terms:
+            return []
+
+        columns = 'users.user_id, users.username, users.first_name, users.last_name, users.phone, users.purchases_count'
+        like = '(users.username LIKE ? OR users.first_name LIKE ? OR users.last_name LIKE ? OR users.phone_norm LIKE ?)'
+        long_terms = [t for t in terms if len(t) >= 3]
+        if not self.fts_enabled or not long_terms:
+            # Короткие запросы (1–2 символа) триграммами не ищутся
+            where = ' AND '.join([like] * len(terms))
+            params = [f'%{t}%' for t in terms for _ in range(4)]
+            return self._read(f'SELECT {columns} FROM users WHERE {where} ORDER BY user_id LIMIT ? OFFSET ?',
+                              (*params, limit, offset))
+
+        # Короткие слова («Ан 4422») триграммы не покрывают — фильтруем результат FTS через LIKE
+        short_terms = [t for t in terms if len(t) < 3]
+        short_where = ''.join(f' AND {like}' for _ in short_terms)
+        short_params = [f'%{t}%' for t in short_terms for _ in range(4)]
+        sql = f'''
+            SELECT {columns} FROM users_fts JOIN users ON users.user_id = users_fts.rowid
+            WHERE users_fts MATCH ?{short_where} ORDER BY rank LIMIT ? OFFSET ?
+        '''
+        exact = ' AND '.join(self._fts_phrase(t) for t in long_terms)
+        rows = self._read(sql, (exact, *short_params, limit, offset))
+        if rows or offset:
+            return rows
+
+        # Нечёткий поиск: любые общие триграммы, лучшие совпадения первыми
+        trigrams = {t[i:i + 3] for t in long_terms for i in range(len(t) - 2)}
+        fuzzy = ' OR '.join(self._fts_phrase(t) for t in sorted(trigrams))
+        return self._read(sql, (fuzzy, *short_params, limit, offset))
 
     def get_user_by_username_exact(self, username: str):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT user_id, username, first_name, last_name FROM users WHERE username = ? LIMIT 1', (username,))
-        return cursor.fetchone()
+        return self._read('SELECT user_id, username, first_name, last_name FROM users WHERE username = ? LIMIT 1', (username,), one=True)
+
+    # === QR-КАРТОЧКИ ===
+    def get_qr_file_id(self, user_id, card_key):
+        """file_id карточки в Telegram, если она уже отправлялась с тем же card_key (см. card_cache_key)"""
+        row = self._read('SELECT file_id FROM qr_file_ids WHERE user_id = ? AND card_key = ?',
+                         (user_id, card_key), one=True)
+        return row[0] if row else None
+
+    @write_op
+    def set_qr_file_id(self, user_id, card_key, file_id):
+        return lambda conn: conn.execute('INSERT OR REPLACE INTO qr_file_ids (user_id, card_key, file_id) VALUES (?, ?, ?)',
+                                         (user_id, card_key, file_id)).rowcount
+
+    @write_op
+    def delete_qr_file_id(self, user_id):
+        return lambda conn: conn.execute('DELETE FROM qr_file_ids WHERE user_id = ?', (user_id,)).rowcount
+
+    # === РАССЫЛКИ ===
+    # Задание рассылки хранится в broadcasts, получатели фиксируются при создании
+    # в broadcast_deliveries. Перед отправкой получатель помечается sending,
+    # после — sent/failed (итоги пишутся пачками), поэтому после перезапуска рассылка продолжается
+    # с pending, а sending (отправка могла уйти) становятся unknown и не повторяются;
+    # так же помечаются отправки, оборвавшиеся по таймауту.
+    # Отзыв (status = recalling) идёт по sent с сохранённым message_id:
+    # удалённые становятся deleted, неудачные — delete_failed (тоже пачками).
+
+    @write_op
+    def create_broadcast(self, text, target, admin_id=None, chat_id=None, status_message_id=None):
+        """Создаёт задание и список получателей одним INSERT ... SELECT. Возвращает (id, получателей)"""
+        where, params = self._audience_where(target, [admin_id] if admin_id else [])
+
+        def op(conn):
+            cursor = conn.execute('''
+                INSERT INTO broadcasts (text, target, admin_id, chat_id, status_message_id)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (text, target, admin_id, chat_id, status_message_id))
+            broadcast_id = cursor.lastrowid
+            total = conn.execute(
+                f'INSERT INTO broadcast_deliveries (broadcast_id, user_id) '
+                f'SELECT ?, user_id FROM users WHERE {where}',
+                [broadcast_id] + params,
+            ).rowcount
+            return broadcast_id, total
+
+        return op
+
+    def get_broadcast(self, broadcast_id):
+        """(id, text, target, admin_id, chat_id, status_message_id, status, created_at, finished_at)"""
+        return self._read('''
+            SELECT id, text, target, admin_id, chat_id, status_message_id, status, created_at, finished_at
+            FROM broadcasts WHERE id = ?
+        ''', (broadcast_id,), one=True)
+
+    def get_active_broadcasts(self):
+        """[(id, status)] заданий, которые нужно выполнить: отправка (running) или отзыв (recalling)"""
+        return self._read("SELECT id, status FROM broadcasts WHERE status IN ('running', 'recalling') ORDER BY id")
+
+    def list_broadcasts(self, limit=10):
+        """Последние рассылки: [(id, text, target, status, created_at, доставлено, получателей)]"""
+        return self._read('''
+            SELECT b.id, b.text, b.target, b.status, b.created_at,
+                   SUM(d.message_id IS NOT NULL), COUNT(d.user_id)
+            FROM broadcasts b LEFT JOIN broadcast_deliveries d ON d.broadcast_id = b.id
+            GROUP BY b.id ORDER BY b.id DESC LIMIT ?
+        ''', (limit,))
+
+    @write_op
+    def reset_inflight_deliveries(self, broadcast_id):
+        """sending, оставшиеся от прошлого запуска, → unknown. Возвращает их число"""
+        return lambda conn: conn.execute(
+            "UPDATE broadcast_deliveries SET status = 'unknown' WHERE broadcast_id = ? AND status = 'sending'",
+            (broadcast_id,),
+        ).rowcount
+
+    def get_pending_deliveries(self, broadcast_id, after_id=0, limit=500):
+        rows = self._read('''
+            SELECT user_id FROM broadcast_deliveries
+            WHERE broadcast_id = ? AND user_id > ? AND status = 'pending'
+            ORDER BY user_id LIMIT ?
+        ''', (broadcast_id, after_id, limit))
+        return [row[0] for row in rows]
+
+    @write_op
+    def mark_delivery_sending(self, broadcast_id, user_id):
+        return lambda conn: conn.execute(
+            "UPDATE broadcast_deliveries SET status = 'sending' WHERE broadcast_id = ? AND user_id = ?",
+            (broadcast_id, user_id),
+        ).rowcount
+
+    @write_op
+    def set_delivery_results(self, broadcast_id, results):
+        """Итоги отправок [(user_id, status, message_id, error)] одной транзакцией"""
+        def op(conn):
+            conn.executemany('''
+                UPDATE broadcast_deliveries SET status = ?, message_id = ?, error = ?
+                WHERE broadcast_id = ? AND user_id = ?
+            ''', [(status, message_id, error, broadcast_id, user_id)
+                  for user_id, status, message_id, error in results])
+
+        return op
+
+    def get_broadcast_progress(self, broadcast_id):
+        """{статус доставки: количество}"""
+        return dict(self._read(
+            'SELECT status, COUNT(*) FROM broadcast_deliveries WHERE broadcast_id = ? GROUP BY status',
+            (broadcast_id,),
+        ))
+
+    def get_broadcast_failures(self, broadcast_id):
+        """{причина: количество} неудачных отправок (error хранится как «причина: текст»)"""
+        return dict(self._read('''
+            SELECT substr(error, 1, instr(error, ':') - 1), COUNT(*) FROM broadcast_deliveries
+            WHERE broadcast_id = ? AND status = 'failed' AND instr(error, ':') > 0
+            GROUP BY 1
+        ''', (broadcast_id,)))
+
+    @write_op
+    def finish_broadcast(self, broadcast_id, status='done'):
+        return lambda conn: conn.execute(
+            'UPDATE broadcasts SET status = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?',
+            (status, broadcast_id),
+        ).rowcount
+
+    @write_op
+    def start_recall(self, broadcast_id, chat_id=None, status_message_id=None):
+        """
+        Переводит законченную рассылку в отзыв; прогресс будет в сообщении status_message_id.
+        False, если рассылки нет, она ещё отправляется или уже удалена.
+        """
+        return lambda conn: conn.execute('''
+            UPDATE broadcasts SET status = 'recalling', chat_id = ?, status_message_id = ?
+            WHERE id = ? AND status IN ('done', 'failed', 'recall_failed')
+        ''', (chat_id, status_message_id, broadcast_id)).rowcount > 0
+
+    def get_recall_batch(self, broadcast_id, after_id=0, limit=500):
+        """[(user_id, message_id)] ещё не удалённых сообщений рассылки"""
+        return self._read('''
+            SELECT user_id, message_id FROM broadcast_deliveries
+            WHERE broadcast_id = ? AND user_id > ? AND status = 'sent' AND message_id IS NOT NULL
+            ORDER BY user_id LIMIT ?
+        ''', (broadcast_id, after_id, limit))
+
+    @write_op
+    def set_recall_results(self, broadcast_id, results):
+        """Итоги удаления [(user_id, удалено, ошибка)] одной транзакцией"""
+        return lambda conn: conn.executemany(
+            'UPDATE broadcast_deliveries SET status = ?, error = ? WHERE broadcast_id = ? AND user_id = ?',
+            [('deleted' if deleted else 'delete_failed', error, broadcast_id, user_id)
+             for user_id, deleted, error in results],
+        ).rowcount
 
     # === БАРИСТЫ ===
     def is_user_barista(self, username):
         if not username:
             return False
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM baristas WHERE username = ? AND is_active = 1', (username,))
-        return cursor.fetchone() is not None
+        return username in self._barista_usernames
 
     def add_barista(self, username, first_name="", last_name=""):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            INSERT OR REPLACE INTO baristas (username, first_name, last_name) 
-            VALUES (?, ?, ?)
-        ''', (username, first_name, last_name))
-        self.conn.commit()
+        with self._roles_lock:
+            self._execute('''
+                INSERT OR REPLACE INTO baristas (username, first_name, last_name) 
+                VALUES (?, ?, ?)
+            ''', (username, first_name, last_name))
+            self._barista_usernames = self._barista_usernames | {username}
         return True
 
     def remove_barista(self, username):
-        cursor = self.conn.cursor()
-        cursor.execute('UPDATE baristas SET is_active = 0 WHERE username = ?', (username,))
-        self.conn.commit()
-        return cursor.rowcount > 0
+        with self._roles_lock:
+            removed = self._execute('UPDATE baristas SET is_active = 0 WHERE username = ?', (username,)) > 0
+            self._barista_usernames = self._barista_usernames - {username}
+        return removed
 
     def get_all_baristas(self):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM baristas WHERE is_active = 1')
-        return cursor.fetchall()
+        return self._read('SELECT * FROM baristas WHERE is_active = 1')
     
     def clean_invalid_baristas(self):
         """Удаляет некорректные записи бариста"""
-        cursor = self.conn.cursor()
         # Удаляем записи с некорректными username
         invalid_usernames = ['Список', 'Удалить', 'Добавить', 'Назад', '📋 Список', '➖ Удалить', '➕ Добавить', '🔙 Назад']
-        for username in invalid_usernames:
-            cursor.execute('UPDATE baristas SET is_active = 0 WHERE username = ?', (username,))
-        self.conn.commit()
+
+        def op(conn):
+            for username in invalid_usernames:
+                conn.execute('UPDATE baristas SET is_active = 0 WHERE username = ?', (username,))
+
+        with self._roles_lock:
+            self._write(op)
+            self._barista_usernames = self._barista_usernames - set(invalid_usernames)
         return True
 
     # === АКЦИИ ===
-    def get_promotion(self):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM promotions WHERE is_active = 1 LIMIT 1')
-        return cursor.fetchone()
+    def get_promotion(self) -> Optional[Promotion]:
+        """Текущий снимок акции из памяти (None, если активной акции нет)"""
+        return self._promotion
+
+    def _reload_promotion(self):
+        """Перечитывает акцию из БД и атомарно подменяет снимок, повышая версию"""
+        with self._promotion_lock:
+            row = self._read('SELECT id, name, required_purchases, description, is_active FROM promotions WHERE is_active = 1 LIMIT 1', one=True)
+            version = self._promotion.version + 1 if self._promotion else 1
+            self._promotion = Promotion(*row, version=version) if row else None
 
     def update_promotion(self, required_purchases=None, description=None, name=None):
-        cursor = self.conn.cursor()
-        if required_purchases:
-            cursor.execute('UPDATE promotions SET required_purchases = ? WHERE is_active = 1', (required_purchases,))
-        if description:
-            cursor.execute('UPDATE promotions SET description = ? WHERE is_active = 1', (description,))
-        if name:
-            cursor.execute('UPDATE promotions SET name = ? WHERE is_active = 1', (name,))
-        self.conn.commit()
+        def op(conn):
+            if required_purchases:
+                conn.execute('UPDATE promotions SET required_purchases = ? WHERE is_active = 1', (required_purchases,))
+            if description:
+                conn.execute('UPDATE promotions SET description = ? WHERE is_active = 1', (description,))
+            if name:
+                conn.execute('UPDATE promotions SET name = ? WHERE is_active = 1', (name,))
+
+        self._write(op)
+        self._reload_promotion()
 
     # === АДМИНЫ ===
     def add_admin(self, user_id: int) -> bool:
-        cursor = self.conn.cursor()
-        cursor.execute('INSERT OR REPLACE INTO admins (user_id, is_active) VALUES (?, 1)', (user_id,))
-        self.conn.commit()
+        with self._roles_lock:
+            self._execute('INSERT OR REPLACE INTO admins (user_id, is_active) VALUES (?, 1)', (user_id,))
+            self._admin_ids_db = self._admin_ids_db | {user_id}
         return True
 
     def remove_admin(self, user_id: int) -> bool:
-        cursor = self.conn.cursor()
-        cursor.execute('UPDATE admins SET is_active = 0 WHERE user_id = ?', (user_id,))
-        self.conn.commit()
-        return cursor.rowcount > 0
+        with self._roles_lock:
+            removed = self._execute('UPDATE admins SET is_active = 0 WHERE user_id = ?', (user_id,)) > 0
+            self._admin_ids_db = self._admin_ids_db - {user_id}
+        return removed
 
     def is_user_admin_db(self, user_id: int) -> bool:
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT 1 FROM admins WHERE user_id = ? AND is_active = 1', (user_id,))
-        return cursor.fetchone() is not None
+        return user_id in self._admin_ids_db
 
     def get_all_admins(self):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT user_id FROM admins WHERE is_active = 1')
-        return [row[0] for row in cursor.fetchall()]
+        return [row[0] for row in self._read('SELECT user_id FROM admins WHERE is_active = 1')]
+
+    # === РОЛИ ===
+    def _load_roles(self):
+        """Загружает активных барист и админов из БД в память"""
+        with self._roles_lock:
+            self._barista_usernames = frozenset(row[0] for row in self._read('SELECT username FROM baristas WHERE is_active = 1'))
+            self._admin_ids_db = frozenset(row[0] for row in self._read('SELECT user_id FROM admins WHERE is_active = 1'))
+
+    def is_admin(self, user_id: int) -> bool:
+        """Админ из .env или из таблицы admins"""
+        return user_id in self.config_admin_ids or user_id in self._admin_ids_db
+
+    def get_user_role(self, user_id, username):
+        """Определяет роль пользователя по индексу в памяти, без запросов к БД"""
+        if self.is_admin(user_id):
+            return 'admin'
+        elif username and username in self._barista_usernames:
+            return 'barista'
+        else:
+            return 'client'
     
         # === БЭКАП ===
 
-    def backup_db(self) -> str:
-        """Создаёт копию БД и возвращает путь до файла"""
+    def backup_db(self, pages=256, sleep=0.005) -> str:
+        """
+        Создаёт копию БД через SQLite online backup API и возвращает путь до файла.
+        Копирование идёт порциями по pages страниц с паузой sleep между ними
+        на отдельном соединении, поэтому запросы бота не простаивают. Если базу
+        изменили посреди копирования, SQLite начинает заново — копия всегда
+        согласованная (в отличие от копирования файла).
+        """
         os.makedirs('backup', exist_ok=True)
         date_str = datetime.now().strftime('%Y-%m-%d_%H-%M')
         backup_path = f'backup/coffee_bot_{date_str}.db'
-        main_db_path = self.conn.cursor().execute('PRAGMA database_list').fetchone()[2]
-        shutil.copyfile(main_db_path, backup_path)
+
+        target = sqlite3.connect(backup_path)
+        try:
+            if self.db_name == ':memory:':
+                with self._lock:
+                    self.conn.backup(target)
+            else:
+                source = sqlite3.connect(self.db_name)
+                try:
+                    source.backup(target, pages=pages, sleep=sleep)
+                finally:
+                    source.close()
+        finally:
+            target.close()
         return backup_path
     
     def cleanup_old_backups(self, keep=7):
@@ -219,41 +917,109 @@ class Database:
             pass  # молчим, если не получилось
     
     def get_all_users(self):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT user_id, username, first_name, last_name, purchases_count FROM users ORDER BY created_at DESC')
-        return cursor.fetchall()
+        return self._read('SELECT user_id, username, first_name, last_name, purchases_count FROM users ORDER BY created_at DESC')
     
+    def _audience_where(self, segment, exclude_ids=()):
+        """WHERE и параметры для сегмента рассылки"""
+        if segment not in AUDIENCE_SEGMENTS:
+            raise ValueError(f"Неизвестный сегмент рассылки: {segment}")
+        template = AUDIENCE_SEGMENTS[segment]
+        admins = sorted(self.config_admin_ids)
+        # недоступные (заблокировали бота и т.п.) не входят ни в один сегмент
+        where = f"unreachable IS NULL AND ({template.format(admins=', '.join('?' * len(admins)))})"
+        params = admins * template.count('{admins}')
+        exclude_ids = list(exclude_ids)
+        if exclude_ids:
+            where = f"({where}) AND user_id NOT IN ({', '.join('?' * len(exclude_ids))})"
+            params += exclude_ids
+        return where, params
+
     def get_all_user_ids(self): 
         """Получить всех пользователей бота (только user_id для рассылки)"""
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT user_id FROM users')
-        return [row[0] for row in cursor.fetchall()]  # ← возвращаем список ID
+        return [row[0] for row in self._read('SELECT user_id FROM users')]  # ← возвращаем список ID
     
     def find_user_by_phone(self, phone_number):
         """Ищет пользователя по номеру телефона"""
-        cursor = self.conn.cursor()
+    # Нормализуем номер так же, как при записи
+        normalized_phone = normalize_phone(phone_number)
+        if not normalized_phone:
+            return None
     
-    # Нормализуем номер (оставляем только цифры)
-        normalized_phone = ''.join(filter(str.isdigit, phone_number))
-    
-    # Ищем в базе
-        cursor.execute('SELECT user_id FROM users WHERE phone = ?', (normalized_phone,))
-    
-        result = cursor.fetchone()
+    # Ищем по индексу idx_users_phone_norm
+        result = self._read('SELECT user_id FROM users WHERE phone_norm = ?', (normalized_phone,), one=True)
         return result[0] if result else None
-    
-    def update_database_schema(self):
-        """Обновляет структуру базы данных если нужно"""
-        cursor = self.conn.cursor()
-    
-    # Проверяем есть ли поле phone в таблице users
-        cursor.execute("PRAGMA table_info(users)")
-        columns = [column[1] for column in cursor.fetchall()]
-    
-        if 'phone' not in columns:
-            # Добавляем поле phone если его нет
-            cursor.execute('ALTER TABLE users ADD COLUMN phone TEXT')
-            self.conn.commit()
-            print("✅ Добавлено поле phone в таблицу users")
 
-    
+    def check_query_plans(self):
+        """
+        Проверяет через EXPLAIN QUERY PLAN, что частые точечные запросы
+        (телефон, username, file_id карточки, очередь рассылки) идут по индексу.
+        Вызывается при запуске бота. Возвращает {название: (по_индексу, план)}.
+        """
+        lookups = {
+            'find_user_by_phone': ('SELECT user_id FROM users WHERE phone_norm = ?', ('9996664422',)),
+            'get_user_by_username_exact': ('SELECT user_id, username, first_name, last_name FROM users WHERE username = ? LIMIT 1', ('user',)),
+            'get_qr_file_id': ('SELECT file_id FROM qr_file_ids WHERE user_id = ? AND card_key = ?', (1, 'v2')),
+            'get_pending_deliveries': ('''
+                SELECT user_id FROM broadcast_deliveries
+                WHERE broadcast_id = ? AND user_id > ? AND status = 'pending'
+                ORDER BY user_id LIMIT ?
+            ''', (1, 0, 500)),
+        }
+        plans = {}
+        for name, (sql, params) in lookups.items():
+            rows = self._read('EXPLAIN QUERY PLAN ' + sql, params)
+            detail = '; '.join(row[-1] for row in rows)
+            plans[name] = ('USING INDEX' in detail or 'USING COVERING INDEX' in detail
+                           or 'PRIMARY KEY' in detail, detail)
+        return plans
+
+
+class AsyncDatabase:
+    """
+    Асинхронный фасад над Database.
+    Каждый вызов выполняется в выделенном потоке БД, поэтому обработчики
+    не блокируют event loop на диске: await adb.get_user_stats(user_id).
+    Методы записи (@write_op) в режиме WAL идут прямо в очередь писателя.
+    """
+
+    def __init__(self, db: Database, workers: int = 1):
+        self.db = db
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='db')
+
+    async def run(self, func, *args, **kwargs):
+        """Выполняет произвольную функцию в потоке БД"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def write(self, fn):
+        """
+        Отправляет fn(conn) писателю и ждёт подтверждения COMMIT,
+        не занимая поток пула на время ожидания. Без WAL писателя нет
+        и запись выполняется сразу, поэтому уходит в поток БД.
+        """
+        if not self.db.wal:
+            return await self.run(self.db._write, fn)
+        return await asyncio.wrap_future(self.db.submit_write(fn))
+
+    def __getattr__(self, name):
+        attr = getattr(self.db, name)
+        if not callable(attr):
+            return attr
+
+        # Методы записи (@write_op) ждут COMMIT без потока пула
+        build_op = getattr(getattr(type(self.db), name, None), 'build_op', None)
+        if build_op is not None:
+            @functools.wraps(attr)
+            async def write_wrapper(*args, **kwargs):
+                return await self.write(build_op(self.db, *args, **kwargs))
+
+            return write_wrapper
+
+        @functools.wraps(attr)
+        async def wrapper(*args, **kwargs):
+            return await self.run(attr, *args, **kwargs)
+
+        return wrapper
+
+    def close(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,367 @@
+"""
+Бенчмарки QR-карточек.
+
+    python qr_bench.py render --count 500
+    python qr_bench.py corpus --out qr_corpus --count 50
+    python qr_bench.py decode --corpus qr_corpus --save report.json
+    python qr_bench.py decode --corpus qr_corpus --baseline report.json
+
+render — сравнивает прежний рендер карточки (всё рисуется заново) с шаблоном
+QRCardTemplate: проверяет, что PNG совпадают байт в байт, и печатает карточек/сек.
+
+corpus — строит воспроизводимый (по --seed) набор «фотографий» карточек
+с искажениями: поворот, перспектива, размытие, блик, пересжатие JPEG,
+слабый свет. Рядом кладётся manifest.json с ожидаемым текстом QR.
+--bot (или BOT_USERNAME в окружении) — как в qr_cards.py: карточки со ссылкой
+t.me/<бот>?start=cr_<id>, как в продакшене (QR плотнее, чем coffeerina:<id>).
+
+decode — прогоняет корпус через decode_with_trace и печатает p50/p95 времени,
+пиковую память и долю успешных распознаваний по этапам, искажениям и в целом.
+--mode: multi (по умолчанию — как быстрый проход handle_photo: все QR первого
+успешного этапа), single (один QR) или exhaustive (все этапы, как для группового фото).
+С --baseline сравнивает с сохранённым отчётом и завершается с кодом 1,
+если доля успехов упала или p95 заметно вырос.
+"""
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import time
+
+import cv2
+import numpy as np
+import qrcode
+from PIL import Image, ImageDraw, ImageFont
+
+from qr_manager import QRCardTemplate, DECODE_STAGES, card_payload, decode_with_trace, get_card_template
+
+try:
+    import resource  # нет на Windows
+except ImportError:
+    resource = None
+
+
+def legacy_generate_qr_code(user_id: int) -> io.BytesIO:
+    """Прежняя реализация generate_qr_code — эталон дизайна для сравнения"""
+    qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=10, border=4)
+    qr.add_data(f"coffeerina:{user_id}")
+    qr.make(fit=True)
+    qr_img = qr.make_image(fill_color="black", back_color="white")
+
+    width, height = 300, 400
+    background = Image.new('RGB', (width, height), color='#F5F5F5')
+    qr_size = 250
+    qr_img = qr_img.resize((qr_size, qr_size))
+    qr_bg = Image.new('RGB', (qr_size + 20, qr_size + 20), color='white')
+    qr_bg.paste(qr_img, (10, 10))
+    qr_x = (width - qr_size - 20) // 2
+    qr_y = 50
+    background.paste(qr_bg, (qr_x, qr_y))
+
+    draw = ImageDraw.Draw(background)
+    try:
+        font = ImageFont.truetype("arial.ttf", 18)
+    except:
+        font = ImageFont.load_default()
+    text_color = '#333333'
+    text = "CoffeeRina"
+    text_bbox = draw.textbbox((0, 0), text, font=font)
+    draw.text(((width - (text_bbox[2] - text_bbox[0])) // 2, 20), text, fill=text_color, font=font)
+
+    try:
+        small_font = ImageFont.truetype("arial.ttf", 12)
+    except:
+        small_font = ImageFont.load_default()
+    small_text = "Ваш персональный QR-код"
+    small_text_bbox = draw.textbbox((0, 0), small_text, font=small_font)
+    draw.text(((width - (small_text_bbox[2] - small_text_bbox[0])) // 2, qr_y + qr_size + 20),
+              small_text, fill=text_color, font=small_font)
+
+    bio = io.BytesIO()
+    background.save(bio, 'PNG')
+    bio.seek(0)
+    return bio
+
+
+def _cards_per_second(render, count, first_id=1_000_000_000):
+    started = time.perf_counter()
+    for user_id in range(first_id, first_id + count):
+        render(user_id)
+    return count / (time.perf_counter() - started)
+
+
+def bench_render(count):
+    template = QRCardTemplate()
+
+    def render(user_id):
+        return template.render(f"coffeerina:{user_id}")
+
+    sample = range(1_000_000_000, 1_000_000_000 + min(count, 50))
+    mismatches = [uid for uid in sample if render(uid).getvalue() != legacy_generate_qr_code(uid).getvalue()]
+    if mismatches:
+        print(f"❌ PNG отличаются от прежнего дизайна для {len(mismatches)} из {len(sample)}: {mismatches[:5]}")
+    else:
+        print(f"✅ PNG совпадают байт в байт ({len(sample)} карточек)")
+
+    legacy = _cards_per_second(legacy_generate_qr_code, count)
+    templated = _cards_per_second(render, count)
+    print(f"Прежний рендер: {legacy:.1f} карточек/сек")
+    print(f"Шаблон:         {templated:.1f} карточек/сек  (x{templated / legacy:.2f})")
+
+
+# === КОРПУС ДЛЯ РАСПОЗНАВАНИЯ ===
+PHOTO_SIZE = (1280, 960)  # как у фото с телефона после сжатия Telegram
+DISTORTIONS = ('clean', 'rotation', 'perspective', 'blur', 'glare', 'jpeg', 'low_light')
+
+
+def _place_on_photo(card, rng):
+    """Карточка на шумном сером фоне, в случайном месте и масштабе"""
+    width, height = PHOTO_SIZE
+    photo = np.full((height, width, 3), rng.randint(90, 170), np.uint8)
+    noise = np.random.RandomState(rng.randrange(2 ** 31)).normal(0, 6, photo.shape)
+    photo = np.clip(photo + noise, 0, 255).astype(np.uint8)
+
+    scale = rng.uniform(1.2, 2.0)
+    card = cv2.resize(card, None, fx=scale, fy=scale, interpolation=cv2.INTER_LINEAR)
+    ch, cw = card.shape[:2]
+    x = rng.randint(0, width - cw)
+    y = rng.randint(0, height - ch)
+    photo[y:y + ch, x:x + cw] = card
+    return photo, (x, y, cw, ch)
+
+
+def _distort(photo, box, distortion, rng):
+    """Возвращает (фото, качество JPEG, параметры искажения)"""
+    height, width = photo.shape[:2]
+    x, y, cw, ch = box
+    quality = 90
+    params = {}
+
+    if distortion == 'rotation':
+        angle = rng.choice((-1, 1)) * rng.uniform(5, 45)
+        matrix = cv2.getRotationMatrix2D((x + cw / 2, y + ch / 2), angle, 1.0)
+        photo = cv2.warpAffine(photo, matrix, (width, height), borderMode=cv2.BORDER_REPLICATE)
+        params['angle'] = round(angle, 1)
+    elif distortion == 'perspective':
+        shift = rng.uniform(0.05, 0.2)
+        src = np.float32([[x, y], [x + cw, y], [x + cw, y + ch], [x, y + ch]])
+        dst = src + np.float32([[rng.uniform(-shift, shift) * cw, rng.uniform(-shift, shift) * ch]
+                                for _ in range(4)])
+        matrix = cv2.getPerspectiveTransform(src, dst)
+        photo = cv2.warpPerspective(photo, matrix, (width, height), borderMode=cv2.BORDER_REPLICATE)
+        params['shift'] = round(shift, 3)
+    elif distortion == 'blur':
+        sigma = rng.uniform(1.0, 3.5)
+        photo = cv2.GaussianBlur(photo, (0, 0), sigma)
+        params['sigma'] = round(sigma, 2)
+    elif distortion == 'glare':
+        # Светлое пятно поверх части QR
+        cx = x + rng.uniform(0.3, 0.7) * cw
+        cy = y + rng.uniform(0.3, 0.7) * ch
+        radius = rng.uniform(0.15, 0.35) * cw
+        strength = rng.uniform(0.5, 0.9)
+        yy, xx = np.mgrid[0:height, 0:width]
+        mask = np.exp(-((xx - cx) ** 2 + (yy - cy) ** 2) / (2 * radius ** 2))[..., None] * strength
+        photo = (photo * (1 - mask) + 255 * mask).astype(np.uint8)
+        params.update(radius=round(radius), strength=round(strength, 2))
+    elif distortion == 'jpeg':
+        quality = rng.randint(8, 35)
+        params['quality'] = quality
+    elif distortion == 'low_light':
+        gain = rng.uniform(0.15, 0.4)
+        noise = np.random.RandomState(rng.randrange(2 ** 31)).normal(0, 4, photo.shape)
+        photo = np.clip(photo * gain + noise, 0, 255).astype(np.uint8)
+        params['gain'] = round(gain, 2)
+    return photo, quality, params
+
+
+def build_corpus(out_dir, count, seed, bot_username=None):
+    """Рисует карточки, искажает и сохраняет JPEG + manifest.json"""
+    if not bot_username:
+        print("⚠️ Не указан --bot: корпус в старом формате coffeerina:<id>")
+    rng = random.Random(seed)
+    template = get_card_template()
+    os.makedirs(out_dir, exist_ok=True)
+    items = []
+    for user_id in range(1_000_000_000, 1_000_000_000 + count):
+        png = template.render(card_payload(user_id, bot_username)).getvalue()
+        card = cv2.imdecode(np.frombuffer(png, np.uint8), cv2.IMREAD_COLOR)
+        for distortion in DISTORTIONS:
+            photo, box = _place_on_photo(card, rng)
+            photo, quality, params = _distort(photo, box, distortion, rng)
+            ok, jpeg = cv2.imencode('.jpg', photo, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            name = f"{user_id}_{distortion}.jpg"
+            with open(os.path.join(out_dir, name), 'wb') as f:
+                f.write(jpeg.tobytes())
+            items.append({'file': name, 'expected': card_payload(user_id, bot_username),
+                          'distortion': distortion, 'params': params})
+
+    with open(os.path.join(out_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump({'seed': seed, 'count': count, 'bot': bot_username, 'items': items}, f, ensure_ascii=False, indent=1)
+    print(f"✅ Корпус: {len(items)} фото → {out_dir}")
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def _max_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдаёт КБ, macOS — байты
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+# режим → аргументы decode_with_trace (multi, exhaustive)
+DECODE_MODES = {'single': (False, False), 'multi': (True, False), 'exhaustive': (True, True)}
+
+
+def bench_decode(corpus_dir, repeat, mode='multi'):
+    with open(os.path.join(corpus_dir, 'manifest.json'), encoding='utf-8') as f:
+        manifest = json.load(f)
+    items = manifest['items']
+
+    multi, exhaustive = DECODE_MODES[mode]
+
+    # Прогрев: детектор OpenCV и библиотеки грузятся на первом фото
+    with open(os.path.join(corpus_dir, items[0]['file']), 'rb') as f:
+        decode_with_trace(f.read(), multi, exhaustive)
+    rss_before = _max_rss_mb()
+
+    total = []
+    stages = {stage: {'times': [], 'hits': 0} for stage in DECODE_STAGES}
+    by_distortion = {}
+    failures = []
+    for _ in range(repeat):
+        for item in items:
+            with open(os.path.join(corpus_dir, item['file']), 'rb') as f:
+                data = f.read()
+            started = time.perf_counter()
+            text, trace = decode_with_trace(data, multi, exhaustive)
+            total.append(time.perf_counter() - started)
+
+            for stage, seconds, ok in trace:
+                stages[stage]['times'].append(seconds)
+                stages[stage]['hits'] += int(ok)
+            ok = item['expected'] in text if multi else text == item['expected']
+            counts = by_distortion.setdefault(item['distortion'], [0, 0])
+            counts[0] += int(ok)
+            counts[1] += 1
+            if not ok:
+                failures.append(item['file'])
+
+    runs = len(items) * repeat
+    report = {
+        'bot': manifest.get('bot'),
+        'mode': mode,
+        'images': runs,
+        'success_rate': sum(c[0] for c in by_distortion.values()) / runs,
+        'p50_ms': _percentile(total, 50) * 1000,
+        'p95_ms': _percentile(total, 95) * 1000,
+        'max_rss_mb': _max_rss_mb(),
+        'rss_growth_mb': (_max_rss_mb() - rss_before) if resource else None,
+        'stages': {
+            stage: {
+                'calls': len(s['times']),
+                'hits': s['hits'],
+                # доля всех фото, распознанных именно на этом этапе
+                'share': s['hits'] / runs,
+                'p50_ms': _percentile(s['times'], 50) * 1000,
+                'p95_ms': _percentile(s['times'], 95) * 1000,
+            }
+            for stage, s in stages.items()
+        },
+        'distortions': {d: c[0] / c[1] for d, c in by_distortion.items()},
+        'failures': sorted(set(failures)),
+    }
+    return report
+
+
+def print_decode_report(report):
+    print(f"Формат QR: {'t.me/' + report['bot'] if report.get('bot') else 'coffeerina:<id>'}  режим: {report['mode']}")
+    print(f"Фото: {report['images']}  успех: {report['success_rate']:.1%}  "
+          f"p50: {report['p50_ms']:.1f} мс  p95: {report['p95_ms']:.1f} мс")
+    if report['max_rss_mb'] is not None:
+        print(f"Память: пик RSS {report['max_rss_mb']:.0f} МБ (+{report['rss_growth_mb']:.0f} МБ за прогон)")
+    print(f"\n{'этап':<18}{'вызовы':>8}{'успехи':>8}{'доля':>8}{'p50 мс':>9}{'p95 мс':>9}")
+    for stage, s in report['stages'].items():
+        print(f"{stage:<18}{s['calls']:>8}{s['hits']:>8}{s['share']:>8.1%}{s['p50_ms']:>9.1f}{s['p95_ms']:>9.1f}")
+    print(f"\n{'искажение':<18}{'успех':>8}")
+    for distortion, rate in report['distortions'].items():
+        print(f"{distortion:<18}{rate:>8.1%}")
+    if report['failures']:
+        print(f"\nНе распознаны ({len(report['failures'])}): {', '.join(report['failures'][:10])}")
+
+
+def compare_with_baseline(report, baseline, p95_tolerance):
+    """Возвращает список регрессий относительно сохранённого отчёта"""
+    problems = []
+    if report['mode'] != baseline.get('mode', 'single'):
+        problems.append(f"другой режим распознавания ({baseline.get('mode', 'single')} → {report['mode']})")
+    if report.get('bot') != baseline.get('bot'):
+        problems.append(f"корпус с другим форматом QR (бот {baseline.get('bot')} → {report.get('bot')})")
+    if report['success_rate'] < baseline['success_rate']:
+        problems.append(f"успех {baseline['success_rate']:.1%} → {report['success_rate']:.1%}")
+    for distortion, rate in baseline['distortions'].items():
+        current = report['distortions'].get(distortion, 0.0)
+        if current < rate:
+            problems.append(f"{distortion}: {rate:.1%} → {current:.1%}")
+    if report['p95_ms'] > baseline['p95_ms'] * p95_tolerance:
+        problems.append(f"p95 {baseline['p95_ms']:.1f} → {report['p95_ms']:.1f} мс")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки QR-карточек")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    render = sub.add_parser('render', help='скорость рендера карточек')
+    render.add_argument('--count', type=int, default=500)
+
+    corpus = sub.add_parser('corpus', help='построить корпус искажённых фото')
+    corpus.add_argument('--out', default='qr_corpus')
+    corpus.add_argument('--count', type=int, default=30, help='карточек (фото на каждое искажение)')
+    corpus.add_argument('--seed', type=int, default=42)
+    corpus.add_argument('--bot', default=os.getenv('BOT_USERNAME'), help='username бота для ссылок в QR')
+
+    dec = sub.add_parser('decode', help='скорость и точность распознавания')
+    dec.add_argument('--corpus', default='qr_corpus')
+    dec.add_argument('--count', type=int, default=30, help='размер корпуса, если его ещё нет')
+    dec.add_argument('--seed', type=int, default=42)
+    dec.add_argument('--bot', default=os.getenv('BOT_USERNAME'), help='username бота, если корпус строится заново')
+    dec.add_argument('--repeat', type=int, default=1, help='прогонов корпуса')
+    dec.add_argument('--mode', choices=DECODE_MODES, default='multi', help='режим распознавания (multi — как в боте)')
+    dec.add_argument('--save', help='сохранить отчёт в JSON')
+    dec.add_argument('--baseline', help='сравнить с сохранённым отчётом')
+    dec.add_argument('--p95-tolerance', type=float, default=1.25, help='допустимый рост p95 (в разах)')
+
+    args = parser.parse_args()
+    if args.command == 'render':
+        bench_render(args.count)
+    elif args.command == 'corpus':
+        build_corpus(args.out, args.count, args.seed, args.bot)
+    elif args.command == 'decode':
+        if not os.path.exists(os.path.join(args.corpus, 'manifest.json')):
+            build_corpus(args.corpus, args.count, args.seed, args.bot)
+        report = bench_decode(args.corpus, args.repeat, args.mode)
+        print_decode_report(report)
+        if args.save:
+            with open(args.save, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=1)
+        if args.baseline:
+            with open(args.baseline, encoding='utf-8') as f:
+                problems = compare_with_baseline(report, json.load(f), args.p95_tolerance)
+            if problems:
+                print("\n❌ Регрессии: " + "; ".join(problems))
+                sys.exit(1)
+            print("\n✅ Без регрессий относительно " + args.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""
+Массовая генерация QR-карточек для печати.
+
+    python qr_cards.py --out cards.zip                    # все пользователи из БД
+    python qr_cards.py --csv ids.csv --out cards.zip      # user_id из первого столбца CSV
+    python qr_cards.py --sheets --out sheets.zip          # листы для печати (сетка карточек)
+
+--bot (или BOT_USERNAME в окружении) — username бота для ссылок t.me/<бот>?start=cr_<id>;
+без него карточки печатаются в старом формате coffeerina:<id>.
+
+Карточки рисуются в пуле процессов пачками. Одновременно в работе не больше
+--window пачек, готовые сразу пишутся в ZIP, поэтому память не растёт
+с числом пользователей.
+"""
+import argparse
+import csv
+import io
+import os
+import sqlite3
+import sys
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from pathlib import Path
+
+from PIL import Image
+
+from qr_manager import QRCardTemplate, card_payload, get_card_template
+
+SHEET_MARGIN = 40  # поля листа, px
+SHEET_GAP = 20     # промежуток между карточками, px
+
+
+def read_ids_from_csv(path):
+    """user_id из первого столбца; заголовок и нечисловые строки пропускаем"""
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.reader(f):
+            if row and row[0].strip().isdigit():
+                yield int(row[0].strip())
+
+
+def read_ids_from_db(db_name):
+    """user_id всех пользователей; база открывается только на чтение, без миграций"""
+    path = Path(db_name).resolve().as_posix()
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        return [row[0] for row in conn.execute('SELECT user_id FROM users')]
+    finally:
+        conn.close()
+
+
+def _chunks(ids, size):
+    ids = iter(ids)
+    while True:
+        chunk = list(islice(ids, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def render_cards(user_ids, bot_username=None):
+    """Пачка отдельных карточек: [(user_id, png)]"""
+    template = get_card_template()
+    return [(uid, template.render(card_payload(uid, bot_username)).getvalue()) for uid in user_ids]
+
+
+def render_sheet(user_ids, cols, rows, bot_username=None):
+    """Один лист печати с сеткой карточек cols x rows"""
+    template = get_card_template()
+    w, h = QRCardTemplate.width, QRCardTemplate.height
+    sheet = Image.new('RGB', (
+        2 * SHEET_MARGIN + cols * w + (cols - 1) * SHEET_GAP,
+        2 * SHEET_MARGIN + rows * h + (rows - 1) * SHEET_GAP,
+    ), color='white')
+    for i, uid in enumerate(user_ids):
+        row, col = divmod(i, cols)
+        sheet.paste(template.render_image(card_payload(uid, bot_username)),
+                    (SHEET_MARGIN + col * (w + SHEET_GAP), SHEET_MARGIN + row * (h + SHEET_GAP)))
+    bio = io.BytesIO()
+    sheet.save(bio, 'PNG')
+    return user_ids, bio.getvalue()
+
+
+def generate(user_ids, out_path, workers=None, sheets=False, cols=4, rows=4, batch=32, window=None, bot_username=None):
+    """
+    Рендерит карточки в пуле процессов и пишет их в ZIP по мере готовности.
+    Порядок файлов в архиве совпадает с порядком user_ids.
+    """
+    workers = workers or os.cpu_count() or 1
+    window = window or workers * 2
+    chunk_size = cols * rows if sheets else batch
+
+    started = time.perf_counter()
+    cards = files = 0
+    # PNG уже сжат, повторно сжимать бессмысленно
+    with zipfile.ZipFile(out_path, 'w', compression=zipfile.ZIP_STORED) as zf, \
+            ProcessPoolExecutor(max_workers=workers) as pool:
+        in_flight = deque()
+
+        def flush_one():
+            nonlocal cards, files
+            result = in_flight.popleft().result()
+            if sheets:
+                ids, png = result
+                files += 1
+                zf.writestr(f"sheet_{files:04d}.png", png)
+                cards += len(ids)
+            else:
+                for uid, png in result:
+                    zf.writestr(f"{uid}.png", png)
+                    files += 1
+                    cards += 1
+
+        for chunk in _chunks(user_ids, chunk_size):
+            if len(in_flight) >= window:
+                flush_one()
+            if sheets:
+                in_flight.append(pool.submit(render_sheet, chunk, cols, rows, bot_username))
+            else:
+                in_flight.append(pool.submit(render_cards, chunk, bot_username))
+        while in_flight:
+            flush_one()
+
+    elapsed = time.perf_counter() - started
+    return cards, files, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Массовая генерация QR-карточек для печати")
+    parser.add_argument('--out', required=True, help='путь к ZIP-архиву')
+    parser.add_argument('--csv', help='CSV с user_id в первом столбце (по умолчанию — все пользователи из БД)')
+    parser.add_argument('--db', default='coffee_bot.db', help='файл базы данных')
+    parser.add_argument('--bot', default=os.getenv('BOT_USERNAME'), help='username бота для ссылок в QR')
+    parser.add_argument('--sheets', action='store_true', help='собирать карточки в листы для печати')
+    parser.add_argument('--cols', type=int, default=4, help='карточек в строке листа')
+    parser.add_argument('--rows', type=int, default=4, help='строк на листе')
+    parser.add_argument('--workers', type=int, default=None, help='процессов (по умолчанию — число ядер)')
+    parser.add_argument('--batch', type=int, default=32, help='карточек в одной задаче для ZIP')
+    parser.add_argument('--window', type=int, default=None, help='задач в работе одновременно')
+    args = parser.parse_args()
+
+    if not args.bot:
+        print("⚠️ Не указан --bot: карточки будут в старом формате coffeerina:<id>")
+
+    if args.csv:
+        user_ids = read_ids_from_csv(args.csv)
+    else:
+        user_ids = read_ids_from_db(args.db)
+
+    cards, files, elapsed = generate(
+        user_ids, args.out, workers=args.workers, sheets=args.sheets,
+        cols=args.cols, rows=args.rows, batch=args.batch, window=args.window, bot_username=args.bot,
+    )
+    if not cards:
+        print("❌ Нет пользователей для генерации")
+        sys.exit(1)
+    print(f"✅ {cards} карточек ({files} файлов) → {args.out} за {elapsed:.1f} с "
+          f"({cards / elapsed:.0f} карточек/сек)")
+
+
+if __name__ == '__main__':
+    main()
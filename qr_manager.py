@@ -5,130 +5,424 @@ import cv2
 import numpy as np
 from pyzbar.pyzbar import decode
 from PIL import Image, ImageDraw, ImageFont
-import random
+import os
+import threading
+import asyncio
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+# Версия дизайна карточки: при изменении макета увеличиваем, и все кеши
+# (PNG на диске и file_id в Telegram) перестают использоваться.
+# Кроме версии, ключ кеша включает бота из ссылки в QR (card_cache_key).
+QR_CARD_VERSION = 2
+
+# Карточки v2 кодируют ссылку t.me/<бот>?start=cr_<id>: камера телефона баристы
+# сразу открывает бота, и /start ведёт к клиенту без скачивания и распознавания фото.
+# Старые карточки coffeerina:<id> по-прежнему распознаются.
+START_PAYLOAD_PREFIX = 'cr_'
+_bot_username = None
+
+
+def set_bot_username(username):
+    """Задаётся при старте бота (bot.username); без него карточки в старом формате"""
+    global _bot_username
+    _bot_username = username
+
+def _load_font(size):
+    try:
+        return ImageFont.truetype("arial.ttf", size)
+    except:
+        return ImageFont.load_default()
+
+
+class QRCardTemplate:
+    """
+    Шаблон карточки QR: фон, белая подложка и тексты рисуются один раз,
+    для каждого пользователя вставляется только сам QR. Результат байт в байт
+    совпадает с прежним generate_qr_code (тексты не пересекаются с областью QR).
+    """
 
-def generate_qr_code(user_id: int) -> io.BytesIO:
-    """Генерирует QR-код для пользователя с простым дизайном"""
-    qr_data = f"coffeerina:{user_id}"
-    
-    # Создаем QR-код
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
-    )
-    qr.add_data(qr_data)
-    qr.make(fit=True)
-    
-    # Создаем простое изображение QR-кода
-    qr_img = qr.make_image(fill_color="black", back_color="white")
-    
-    # Создаем простой фон
     width, height = 300, 400
-    background = Image.new('RGB', (width, height), color='#F5F5F5')  # Светло-серый фон
-    
-    # Вставляем QR-код в центр
     qr_size = 250
-    qr_img = qr_img.resize((qr_size, qr_size))
-    
-    # Создаем белый фон для QR-кода
-    qr_bg = Image.new('RGB', (qr_size + 20, qr_size + 20), color='white')
-    qr_bg.paste(qr_img, (10, 10))
-    
-    # Вставляем QR-код на фон
-    qr_x = (width - qr_size - 20) // 2
     qr_y = 50
-    background.paste(qr_bg, (qr_x, qr_y))
-    
-    # Добавляем простой текст
-    draw = ImageDraw.Draw(background)
-    try:
-        font = ImageFont.truetype("arial.ttf", 18)
-    except:
-        font = ImageFont.load_default()
-    
-    # Текст "CoffeeRina"
     text_color = '#333333'  # Темно-серый
-    text = "CoffeeRina"
-    text_bbox = draw.textbbox((0, 0), text, font=font)
-    text_width = text_bbox[2] - text_bbox[0]
-    text_x = (width - text_width) // 2
-    draw.text((text_x, 20), text, fill=text_color, font=font)
-    
-    # Текст "Ваш персональный QR-код"
-    try:
-        small_font = ImageFont.truetype("arial.ttf", 12)
-    except:
-        small_font = ImageFont.load_default()
-    
-    small_text = "Ваш персональный QR-код"
-    small_text_bbox = draw.textbbox((0, 0), small_text, font=small_font)
-    small_text_width = small_text_bbox[2] - small_text_bbox[0]
-    small_text_x = (width - small_text_width) // 2
-    draw.text((small_text_x, qr_y + qr_size + 20), small_text, fill=text_color, font=small_font)
-    
-    # Сохраняем в BytesIO
-    bio = io.BytesIO()
-    background.save(bio, 'PNG')
-    bio.seek(0)
-    return bio
+
+    def __init__(self):
+        self.qr_x = (self.width - self.qr_size - 20) // 2
+        background = Image.new('RGB', (self.width, self.height), color='#F5F5F5')  # Светло-серый фон
+
+        # Белая подложка под QR-код
+        qr_bg = Image.new('RGB', (self.qr_size + 20, self.qr_size + 20), color='white')
+        background.paste(qr_bg, (self.qr_x, self.qr_y))
+
+        draw = ImageDraw.Draw(background)
+        font = _load_font(18)
+        small_font = _load_font(12)
+
+        # Текст "CoffeeRina"
+        text = "CoffeeRina"
+        text_bbox = draw.textbbox((0, 0), text, font=font)
+        text_x = (self.width - (text_bbox[2] - text_bbox[0])) // 2
+        draw.text((text_x, 20), text, fill=self.text_color, font=font)
+
+        # Текст "Ваш персональный QR-код"
+        small_text = "Ваш персональный QR-код"
+        small_text_bbox = draw.textbbox((0, 0), small_text, font=small_font)
+        small_text_x = (self.width - (small_text_bbox[2] - small_text_bbox[0])) // 2
+        draw.text((small_text_x, self.qr_y + self.qr_size + 20), small_text, fill=self.text_color, font=small_font)
+
+        self.background = background
+
+    def render_image(self, qr_data: str) -> Image.Image:
+        qr = qrcode.QRCode(
+            version=1,
+            error_correction=qrcode.constants.ERROR_CORRECT_L,
+            box_size=10,
+            border=4,
+        )
+        qr.add_data(qr_data)
+        qr.make(fit=True)
+        qr_img = qr.make_image(fill_color="black", back_color="white").resize((self.qr_size, self.qr_size))
+
+        card = self.background.copy()
+        card.paste(qr_img, (self.qr_x + 10, self.qr_y + 10))
+        return card
+
+    def render(self, qr_data: str) -> io.BytesIO:
+        bio = io.BytesIO()
+        self.render_image(qr_data).save(bio, 'PNG')
+        bio.seek(0)
+        return bio
+
+
+_card_template = None
+
+def get_card_template() -> QRCardTemplate:
+    """Шаблон создаётся один раз на процесс"""
+    global _card_template
+    if _card_template is None:
+        _card_template = QRCardTemplate()
+    return _card_template
+
+
+def card_payload(user_id: int, bot_username=None) -> str:
+    """Что зашито в QR карточки пользователя"""
+    bot_username = bot_username or _bot_username
+    if bot_username:
+        return f"https://t.me/{bot_username}?start={START_PAYLOAD_PREFIX}{user_id}"
+    return f"coffeerina:{user_id}"
+
+
+def card_cache_key(bot_username=None) -> str:
+    """
+    Ключ кешей карточки (каталог PNG и file_id): версия дизайна и бот,
+    на которого ведёт ссылка в QR. Карточки, нарисованные до set_bot_username
+    или для прежнего username бота, под новым ключом не найдутся.
+    """
+    bot_username = bot_username or _bot_username
+    return f"v{QR_CARD_VERSION}-{bot_username.lower() if bot_username else 'legacy'}"
+
+
+def generate_qr_code(user_id: int) -> io.BytesIO:
+    """Генерирует QR-код для пользователя с простым дизайном"""
+    return get_card_template().render(card_payload(user_id))
+
+class QRCardCache:
+    """
+    Кеш готовых карточек QR: ограниченный LRU в памяти + PNG на диске.
+    Карточка пользователя не меняется, поэтому рисуем её один раз.
+    """
+
+    def __init__(self, cache_dir='qr_cache', max_items=256):
+        self.cache_dir = cache_dir
+        self.max_items = max_items
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int) -> bytes:
+        """Возвращает PNG карточки: из памяти, с диска или рисует заново"""
+        key = (card_cache_key(), user_id)
+        with self._lock:
+            png = self._memory.get(key)
+            if png is not None:
+                self._memory.move_to_end(key)
+                return png
+
+        cache_dir = os.path.join(self.cache_dir, key[0])
+        path = os.path.join(cache_dir, f'{user_id}.png')
+        try:
+            with open(path, 'rb') as f:
+                png = f.read()
+        except OSError:
+            png = generate_qr_code(user_id).getvalue()
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp_path = f'{path}.{threading.get_ident()}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(png)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print(f"⚠️ Не удалось сохранить QR в кеш: {e}")
+
+        with self._lock:
+            self._memory[key] = png
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_items:
+                self._memory.popitem(last=False)
+        return png
+
+
+def parse_start_payload(payload: str):
+    """ID клиента из параметра /start (cr_123456) или None"""
+    match = re.fullmatch(START_PAYLOAD_PREFIX + r'(\d+)', (payload or '').strip())
+    if match:
+        return int(match.group(1))
+    return None
+
 
 def parse_qr_data(qr_text: str):
     """
     Парсит данные из текста QR-кода
-    Формат: coffeerina:123456
+    Форматы: coffeerina:123456 и https://t.me/<бот>?start=cr_123456.
+    Ссылка принимается только на нашего бота (если username уже известен)
+    и только целиком: cr_12abc или cr_12&foo — не карточка.
     """
-    match = re.match(r'coffeerina:(\d+)', qr_text.strip())
+    qr_text = qr_text.strip()
+    match = re.fullmatch(r'coffeerina:(\d+)', qr_text)
     if match:
         return int(match.group(1))
+    match = re.fullmatch(r'(?:https?://)?t\.me/(\w+)/?\?start=' + START_PAYLOAD_PREFIX + r'(\d+)', qr_text)
+    if match:
+        if _bot_username and match.group(1).lower() != _bot_username.lower():
+            return None
+        return int(match.group(2))
+    return None
+
+# === РАСПОЗНАВАНИЕ ===
+# Фото декодируется один раз сразу в оттенки серого, дальше этапы идут от
+# дешёвых к дорогим и останавливаются на первом успехе (с exhaustive=True
+# проходят все, и найденные коды объединяются — полный поиск карточек на групповом фото):
+#   pyzbar_small     — pyzbar на уменьшенной копии (большинство фото карточек)
+#   pyzbar_full      — pyzbar в полном разрешении (мелкий QR на большом фото)
+#   opencv           — cv2.QRCodeDetector (другой детектор, бывает устойчивее)
+#   pyzbar_threshold — pyzbar после бинаризации Оцу (блики, тени, низкий контраст)
+# По каждому этапу копится статистика: вызовы, успехи, суммарное время.
+
+DOWNSCALE_MAX_SIDE = 800
+DECODE_STAGES = ('imdecode', 'pyzbar_small', 'pyzbar_full', 'opencv', 'pyzbar_threshold')
+
+_qr_detector = None
+_decode_stats = {stage: {'calls': 0, 'hits': 0, 'seconds': 0.0} for stage in DECODE_STAGES}
+_decode_stats_lock = threading.Lock()
+
+
+def _get_qr_detector():
+    """Один cv2.QRCodeDetector на процесс вместо нового на каждое фото"""
+    global _qr_detector
+    if _qr_detector is None:
+        _qr_detector = cv2.QRCodeDetector()
+    return _qr_detector
+
+
+def _unique(texts):
+    return list(dict.fromkeys(t for t in texts if t))
+
+
+def _pyzbar_first(img, multi=False):
+    decoded_objects = decode(img)
+    if multi:
+        return _unique(obj.data.decode('utf-8') for obj in decoded_objects)
+    if decoded_objects:
+        return decoded_objects[0].data.decode('utf-8')
+    return None
+
+
+def _opencv_decode(img, multi=False):
+    if multi:
+        # detectAndDecodeMulti на части фото падает или не видит QR, который
+        # находит обычный detectAndDecode, поэтому при неудаче пробуем и его
+        try:
+            ok, texts, points, _ = _get_qr_detector().detectAndDecodeMulti(img)
+            texts = _unique(texts) if ok else []
+        except cv2.error:
+            texts = []
+        if texts:
+            return texts
+        data = _opencv_decode(img)
+        return [data] if data else []
+    data, points, _ = _get_qr_detector().detectAndDecode(img)
+    if points is not None and data:
+        return data
     return None
 
-def read_qr_from_image(image_data: bytes):
+
+def _threshold_decode(img, multi=False):
+    _, binary = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return _pyzbar_first(binary, multi)
+
+
+def decode_with_trace(image_data, multi=False, exhaustive=False):
+    """
+    Распознаёт QR поэтапно (image_data — bytes или bytearray файла).
+    Возвращает (текст или None, trace),
+    где trace — список (этап, секунды, успех) для выполненных этапов.
+    С multi=True вместо текста — список всех разных QR, найденных первым
+    успешным этапом (несколько карточек на одном фото). С exhaustive=True
+    (вместе с multi) этапы не останавливаются на первом успехе, ведь каждый
+    может найти не все карточки, и их результаты объединяются.
+    """
+    trace = []
+    started = time.perf_counter()
+    gray = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_GRAYSCALE)
+    trace.append(('imdecode', time.perf_counter() - started, gray is not None))
+    if gray is None:
+        return ([] if multi else None), trace
+
+    height, width = gray.shape[:2]
+    scale = DOWNSCALE_MAX_SIDE / max(height, width)
+    small = None
+    if scale < 1:
+        small = cv2.resize(gray, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+
+    stages = [
+        ('pyzbar_small', lambda: _pyzbar_first(small if small is not None else gray, multi)),
+        ('pyzbar_full', lambda: _pyzbar_first(gray, multi)),
+        ('opencv', lambda: _opencv_decode(gray, multi)),
+        ('pyzbar_threshold', lambda: _threshold_decode(gray, multi)),
+    ]
+    found = []
+    for stage, run in stages:
+        if stage == 'pyzbar_full' and small is None:
+            continue  # фото и так маленькое, полное разрешение уже проверено
+        started = time.perf_counter()
+        try:
+            data = run()
+        except Exception as e:
+            print(f"❌ Ошибка этапа {stage}: {e}")
+            data = None
+        trace.append((stage, time.perf_counter() - started, bool(data)))
+        if data and not exhaustive:
+            return data, trace
+        if data:
+            found = _unique(found + data)
+    return (found if multi else None), trace
+
+
+def record_decode_trace(trace):
+    """Добавляет trace одного распознавания в статистику этапов"""
+    with _decode_stats_lock:
+        for stage, seconds, ok in trace:
+            stats = _decode_stats[stage]
+            stats['calls'] += 1
+            stats['hits'] += int(ok)
+            stats['seconds'] += seconds
+
+
+def get_decode_stats():
+    """Копия статистики: {этап: {'calls', 'hits', 'seconds'}}"""
+    with _decode_stats_lock:
+        return {stage: dict(stats) for stage, stats in _decode_stats.items()}
+
+
+def read_qr_from_image(image_data: bytes, multi=False, exhaustive=False):
     """
     Распознает QR-код с изображения.
     Возвращает сырой текст QR (str) либо None, если распознать не удалось.
+    С multi=True — список текстов всех QR на фото (пустой, если ничего нет),
+    exhaustive — как у decode_with_trace.
     """
     try:
-        nparr = np.frombuffer(image_data, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-
-        # Попытка 1: pyzbar на исходном изображении
-        if img is not None:
-            decoded_objects = decode(img)
-            if decoded_objects:
-                return decoded_objects[0].data.decode('utf-8')
-
-        # Попытка 2: OpenCV QRCodeDetector
-        if img is not None:
-            detector = cv2.QRCodeDetector()
-            data, points, _ = detector.detectAndDecode(img)
-            if points is not None and data:
-                return data
-
-        # Попытка 3: pyzbar на оттенках серого
-        if img is not None:
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            decoded_objects = decode(gray)
-            if decoded_objects:
-                return decoded_objects[0].data.decode('utf-8')
-
-        # Попытка 4: PIL
-        image = Image.open(io.BytesIO(image_data))
-        decoded_objects = decode(image)
-        if decoded_objects:
-            return decoded_objects[0].data.decode('utf-8')
-
-        if data and is_valid_qr_format(data):
-            return data
-        else:
-            print(f"❌ Неверный формат QR-кода: {data}")
-            return None
-            
+        data, trace = decode_with_trace(image_data, multi, exhaustive)
+        record_decode_trace(trace)
+        return data
     except Exception as e:
         print(f"❌ Ошибка распознавания QR: {e}")
-        return None
+        return [] if multi else None
 
 def is_valid_qr_format(qr_text: str) -> bool:
     """Проверяет, соответствует ли текст формату нашего QR-кода"""
-    return bool(re.match(r'coffeerina:\d+', qr_text.strip()))
\ No newline at end of file
+    return parse_qr_data(qr_text) is not None
+
+
+class QRDecodeBusy(Exception):
+    """Очередь распознавания переполнена"""
+
+
+class QRDecodePool:
+    """
+    Распознавание QR в отдельных процессах, чтобы тяжёлый OpenCV/pyzbar
+    не останавливал event loop. Одновременно в работе и в очереди не больше
+    workers + max_queue фото, сверх этого decode() сразу бросает QRDecodeBusy.
+    На каждое фото даётся timeout секунд (asyncio.TimeoutError); процесс,
+    уже взявший задачу, дорабатывает её и занимает слот до конца.
+    workers=0 — распознавание в потоке, без пула процессов.
+    """
+
+    def __init__(self, workers=2, max_queue=8, timeout=10.0):
+        self.workers = workers
+        self.max_pending = max(1, workers) + max_queue
+        self.timeout = timeout
+        self._executor = ProcessPoolExecutor(max_workers=workers) if workers > 0 else None
+        self._pending = 0
+
+    def _release(self, _future=None):
+        self._pending -= 1
+
+    async def decode(self, image_data, multi=False, exhaustive=False):
+        """Возвращает текст QR или None (с multi=True — список), как read_qr_from_image"""
+        if self._pending >= self.max_pending:
+            raise QRDecodeBusy()
+        self._pending += 1
+
+        loop = asyncio.get_running_loop()
+        if self._executor is None:
+            job = loop.run_in_executor(None, decode_with_trace, image_data, multi, exhaustive)
+            # поток не прервать: слот занят, пока распознавание действительно не закончится
+            job.add_done_callback(self._release)
+            data, trace = await asyncio.wait_for(asyncio.shield(job), self.timeout)
+        else:
+            job = self._executor.submit(decode_with_trace, image_data, multi, exhaustive)
+            # слот освобождается, когда процесс действительно закончил (или задача отменена до старта)
+            job.add_done_callback(lambda f: loop.call_soon_threadsafe(self._release))
+            data, trace = await asyncio.wait_for(asyncio.wrap_future(job), self.timeout)
+
+        # статистика этапов копится в основном процессе, воркеры только возвращают trace
+        record_decode_trace(trace)
+        return data
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class QRScanCache:
+    """
+    Результаты распознавания по file_unique_id фото: повторно отправленное
+    или пересланное фото не скачивается и не распознаётся заново.
+    Ограниченный LRU, записи живут ttl секунд. Используется только из event loop.
+    """
+
+    def __init__(self, max_items=512, ttl=600):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, file_unique_id):
+        entry = self._items.get(file_unique_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._items[file_unique_id]
+            self.misses += 1
+            return None
+        self._items.move_to_end(file_unique_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, file_unique_id, value):
+        self._items[file_unique_id] = (time.monotonic() + self.ttl, value)
+        self._items.move_to_end(file_unique_id)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)